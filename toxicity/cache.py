@@ -0,0 +1,298 @@
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from scipy.sparse import issparse
+
+from utils import fingerprint, label_matrix, select_rows, save_sparse_csr, load_sparse_csr, LRUCache
+
+# Maximum total size of the artifacts kept on disk, in bytes
+CACHE_SIZE_DEFAULT = 10 * 2 ** 30
+
+
+class ArtifactCache(object):
+    """
+    A content-addressed cache of preprocessing artifacts on disk.
+
+    Every entry is a directory named after a hash of the input data and of all the parameters that produced it,
+    so many variants of an artifact can be kept side by side. Once the total size of the entries exceeds `max_size`
+    the least recently used ones are evicted.
+
+    Example
+    -------
+        >>> cache = ArtifactCache('data/output/cache')
+        >>> key = cache.key(train, test, stemming=True)
+        >>> entry = cache.get(key)
+        >>> if entry is None:
+        >>>     with cache.put(key, name='sparse') as entry:
+        >>>         save_sparse_csr(os.path.join(entry, 'train'), compute(train))
+    """
+
+    def __init__(self, cache_dir, max_size=CACHE_SIZE_DEFAULT):
+        """
+        :param cache_dir: Directory holding the entries
+        :param max_size: Maximum total size of the entries in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __str__(self):
+        return "ArtifactCache at {}: {} hits, {} misses".format(self.cache_dir, self.hits, self.misses)
+
+    @staticmethod
+    def key(*data, **params):
+        """
+        :param data: The input data of the computation
+        :param params: All the parameters of the computation that influence its output
+        :return: The key identifying the artifacts of the computation, None if a parameter can not be identified
+                 (see `utils.describe`), in which case `get` misses and `put` discards the artifacts
+        """
+        return fingerprint(*data, params)
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        :param key: Key as returned by `key`
+        :return: The directory holding the artifacts of the entry or None if they are not cached
+        """
+        entry = self._entry(key) if key is not None else None
+        if entry is None or not os.path.isdir(entry):
+            self.misses += 1
+            print("Cache miss for {}".format(key))
+            return None
+
+        self.hits += 1
+        print("Cache hit for {}, loading from {}".format(key, entry))
+        # The modification time of an entry is its last usage, used for eviction
+        os.utime(entry, None)
+        return entry
+
+    @contextmanager
+    def put(self, key, name=None):
+        """
+        Context manager yielding the directory where the artifacts of the entry should be written.
+        The entry only becomes visible once the block completes without errors.
+
+        :param key: Key as returned by `key`
+        :param name: If provided, the entry is recorded as the latest one of that name, see `latest`
+        """
+        tmp = os.path.join(self.cache_dir, '.tmp-{}'.format(uuid.uuid4().hex))
+        os.makedirs(tmp)
+        if key is None:
+            try:
+                yield tmp
+            finally:
+                shutil.rmtree(tmp)
+            print("Not caching artifacts whose parameters can not be identified")
+            return
+
+        try:
+            yield tmp
+            entry = self._entry(key)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+        if name:
+            with open(os.path.join(self.cache_dir, name + '.latest'), 'w') as f:
+                f.write(key)
+        print("Cached {} at {}".format(key, entry))
+        self.evict(keep=entry)
+
+    def latest(self, name):
+        """
+        :param name: Name the entry was put with
+        :return: The directory of the latest entry put with the given name or None if there is none
+        """
+        try:
+            with open(os.path.join(self.cache_dir, name + '.latest')) as f:
+                key = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return self.get(key)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in `max_size`.
+
+        :param keep: Directory of an entry which should never be evicted, e.g. the one just put
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            print("Evicting {} from the cache, last used {}".format(entry, time.ctime(os.path.getmtime(entry))))
+            shutil.rmtree(entry)
+            total -= size
+
+
+class Folds(object):
+    """
+    The splits of the rows of a training set used to evaluate predictors, optionally along with the rows of the
+    features of every split, so that they are sliced once instead of once per predictor, tag and fold.
+    """
+
+    def __init__(self, rows, splits, matrices=None, entry=None):
+        """
+        :param rows: None or the index of the rows being split, e.g. once the rare labels are removed
+        :param splits: List of tuples (tags, train_index, val_index), indexing `rows` if provided
+        :param matrices: List of tuples (train_x, val_x) of the features of every split, or None
+        :param entry: Directory of the `FoldCache` entry holding the folds, if they are persisted
+        """
+        self.rows = rows
+        self.splits = splits
+        self.matrices = matrices
+        self.entry = entry
+
+    def __len__(self):
+        return len(self.splits)
+
+    def __getstate__(self):
+        # Persisted matrices are memory-mapped again by every process instead of being pickled
+        state = dict(self.__dict__)
+        if self.entry is not None and self.matrices is not None:
+            state['matrices'] = True
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.matrices is True:
+            self.matrices = self._load_matrices(self.entry, len(self.splits))
+
+    def tags(self, i):
+        return self.splits[i][0]
+
+    def indices(self, i):
+        """
+        :return: Tuple (train_index, val_index) of the i-th split, indexing the labels
+        """
+        return self.splits[i][1], self.splits[i][2]
+
+    def features(self, x, i):
+        """
+        :param x: The features being split
+        :return: Tuple (train_x, val_x) of the rows of the features of the i-th split
+        """
+        if self.matrices is not None:
+            return self.matrices[i]
+        return tuple(select_rows(x, index if self.rows is None else self.rows[index]) for index in self.indices(i))
+
+    def save(self, entry):
+        """
+        Writes the folds to the directory of a cache entry, the features of every split with `save_sparse_csr`.
+        """
+        arrays = {'rows': np.array([] if self.rows is None else self.rows, dtype=np.int64),
+                  'has_rows': np.array(self.rows is not None)}
+        for i, (tags, train_index, val_index) in enumerate(self.splits):
+            arrays.update({'tags_{}'.format(i): np.array(tags), 'train_{}'.format(i): train_index,
+                           'val_{}'.format(i): val_index})
+        np.savez(os.path.join(entry, 'splits.npz'), **arrays)
+
+        for i, (train_x, val_x) in enumerate(self.matrices or []):
+            save_sparse_csr(os.path.join(entry, 'train_x_{}'.format(i)), train_x)
+            save_sparse_csr(os.path.join(entry, 'val_x_{}'.format(i)), val_x)
+
+    @classmethod
+    def load(cls, entry):
+        """
+        Reads the folds written by `save`, memory-mapping the features of every split.
+        """
+        with np.load(os.path.join(entry, 'splits.npz')) as arrays:
+            rows = arrays['rows'] if arrays['has_rows'] else None
+            n_splits = sum(1 for name in arrays.files if name.startswith('tags_'))
+            splits = [(tuple(arrays['tags_{}'.format(i)].tolist()), arrays['train_{}'.format(i)], arrays['val_{}'.format(i)])
+                      for i in range(n_splits)]
+
+        matrices = None
+        if os.path.isdir(os.path.join(entry, 'train_x_0')):
+            matrices = cls._load_matrices(entry, n_splits)
+        return cls(rows, splits, matrices, entry)
+
+    @staticmethod
+    def _load_matrices(entry, n_splits):
+        return [(load_sparse_csr(os.path.join(entry, 'train_x_{}'.format(i)), mmap_mode='r'),
+                 load_sparse_csr(os.path.join(entry, 'val_x_{}'.format(i)), mmap_mode='r')) for i in range(n_splits)]
+
+
+class FoldCache(object):
+    """
+    A cache of the folds used to evaluate predictors, see `Folds`, shared by all the predictors and tuning candidates
+    evaluated on the same data with the same split configuration.
+
+    The folds are kept in memory, and on disk if a directory is given so that they are shared with other processes
+    and runs. The rows of the features of every split are only kept if `materialize` is set, and only for sparse
+    features; on disk they are memory-mapped.
+
+    Example
+    -------
+        >>> fold_cache = FoldCache('data/output/folds', materialize=True)
+        >>> for predictor in predictors:
+        >>>     predictor.evaluate(train_x, train_ys, method='CV', fold_cache=fold_cache)
+    """
+
+    def __init__(self, cache_dir=None, materialize=False, max_size=CACHE_SIZE_DEFAULT, memory_size=16):
+        """
+        :param cache_dir: Directory holding the persisted folds, they are only kept in memory if None
+        :param materialize: Whether the rows of the features of every split are kept as well
+        :param max_size: Maximum total size of the persisted folds in bytes
+        :param memory_size: Maximum number of folds kept in memory
+        """
+        self.cache = ArtifactCache(cache_dir, max_size) if cache_dir else None
+        self.materialize = materialize
+        self._folds = LRUCache(memory_size)
+
+    def __str__(self):
+        return "FoldCache: {} in memory{}".format(self._folds, ", " + str(self.cache) if self.cache else "")
+
+    def folds(self, x, ys, split, **config):
+        """
+        :param x: The features being split
+        :param ys: Dictionary mapping every tag to its labels
+        :param split: Function computing the tuple (rows, splits) of `Folds` from `x`, `ys` and `config` on a miss
+        :param config: The split configuration, e.g. the evaluation method and the number of folds
+        :return: The folds of the data
+        """
+        materialize = self.materialize and issparse(x)
+        # The splits only depend on the number of rows, the labels and the configuration, so the features are only
+        # hashed when their rows are kept as well
+        key = fingerprint(x if materialize else x.shape[0], label_matrix(ys), config)
+        folds = self._folds.get(key)
+        if folds is not None:
+            return folds
+
+        entry = self.cache.get(key) if self.cache else None
+        if entry is not None:
+            folds = Folds.load(entry)
+        else:
+            folds = Folds(*split(x, ys, **config))
+            if materialize:
+                folds.matrices = [tuple(m.tocsr() for m in folds.features(x, i)) for i in range(len(folds))]
+            if self.cache:
+                with self.cache.put(key, name='folds') as tmp:
+                    folds.save(tmp)
+                folds = Folds.load(os.path.join(self.cache.cache_dir, key))
+
+        self._folds.put(key, folds)
+        return folds
@@ -11,7 +11,7 @@ TAGS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
 
 
 def create_ensemble_output(predictor, train_x, train_ys, test_x, train_id, test_id,
-                           data_source_nature, write_to='data/output'):
+                           data_source_nature, write_to='data/output', n_jobs=None):
     """
     Creates the output files for the ensemble algorithm
 
@@ -24,6 +24,7 @@ def create_ensemble_output(predictor, train_x, train_ys, test_x, train_id, test_
     :param to_ensemble: Boolean. True if the output will be ensembled
     :param data_dir: path where the outputs files will be saved
     :param predictor: string with the name of the predictor model used
+    :param n_jobs: Number of processes fitting the tags, see `Predictor.fit_all`
     """
     base_dir = write_to + '/' + predictor.name
 
@@ -33,11 +34,13 @@ def create_ensemble_output(predictor, train_x, train_ys, test_x, train_id, test_
     train = pd.DataFrame({'id': train_id})
     test = pd.DataFrame({'id': test_id})
 
-    for tag in TAGS:
-        print("{} Fitting on {} tag".format(predictor, tag))
-        predictor.fit(train_x, train_ys[tag])
-        train[tag] = predictor.predict_proba(train_x)
-        test[tag] = predictor.predict_proba(test_x)
+    print("{} Fitting on all tags".format(predictor))
+    predictor.fit_all(train_x, train_ys, n_jobs=n_jobs)
+    train_probabilities = predictor.predict_proba_all(train_x)
+    test_probabilities = predictor.predict_proba_all(test_x)
+    for i, tag in enumerate(TAGS):
+        train[tag] = train_probabilities[:, i]
+        test[tag] = test_probabilities[:, i]
 
     test.to_csv(base_dir + '/' + 'test_y_' + data_source_nature + '.csv', index=False)
     train.to_csv(base_dir + '/' + 'train_y_' + data_source_nature + '.csv', index=False)
@@ -1,24 +1,231 @@
 import pandas as pd
-import nltk
-from nltk.corpus import stopwords
 import string
+import re
 import os
-from utils import timing
-from textblob import TextBlob
-
-nltk.download('stopwords')
-eng_stopwords = set(stopwords.words("english"))
+import shutil
+import hashlib
+import multiprocessing
+from functools import lru_cache
+import numpy as np
+from utils import timing, save_dense_frame, load_dense_frame, LRUCache, nltk_data, compact_frame, DedupIndex
+from cache import ArtifactCache, CACHE_SIZE_DEFAULT
 
 # Input dataframes are assumed to contain plain text in this column
 TEXT_COLUMN = "comment_text"
 
+# Columns computed from the words of a comment, see `count_word_features`
+WORD_FEATURES = ['count_words_upper', 'count_word', 'count_unique_word', 'count_words_title', 'count_stopwords']
+
+# Columns added by every extractor of `FeatureAdder`
+FEATURE_COLUMNS = {
+    '_upper': ['count_words_upper'],
+    '_count_words': ['count_word'],
+    '_unique_words': ['count_unique_word'],
+    '_count_letters': ['count_letters'],
+    '_count_punctuation': ['count_punctuations'],
+    '_count_little_case': ['count_words_title'],
+    '_count_stopwords': ['count_stopwords'],
+    '_question_or_exclamation': ['question_mark', 'exclamation_mark'],
+    '_count_bad_words': ['count_bad_words'],
+    '_polarity_subjectivity_score': ['polarity_score', 'subjectivity_score']
+    }
+
+# Used by the worker processes of `FeatureAdder.get_features`, set once per process by `_init_feature_worker`
+_worker_state = {}
+
+# Matches any of the characters counted by `FeatureAdder._count_punctuation`
+PUNCTUATION_PATTERN = '[{}]'.format(re.escape(string.punctuation))
+
+
+def count_word_features(texts, columns=WORD_FEATURES):
+    """
+    Computes the word based features of `FeatureAdder` scanning every comment only once, instead of splitting it
+    again for each feature.
+
+    :param texts: pd.Series of comments
+    :param columns: Names of the features to compute, a subset of `WORD_FEATURES`
+    :return: Dictionary from feature name to a np.ndarray of its values, aligned with `texts`
+    """
+    upper, words, unique, little, stop = (name in columns for name in WORD_FEATURES)
+    eng_stopwords = english_stopwords() if stop else None
+    counts = {name: np.zeros(len(texts), dtype=np.int64) for name in columns}
+    for i, text in enumerate(texts):
+        text = str(text)
+        split = text.split()
+        if upper:
+            counts['count_words_upper'][i] = sum(map(str.isupper, split))
+        if words:
+            counts['count_word'][i] = len(split)
+        if unique:
+            counts['count_unique_word'][i] = len(set(split))
+        if little:
+            counts['count_words_title'][i] = sum(map(str.islower, split))
+        if stop:
+            counts['count_stopwords'][i] = sum(map(eng_stopwords.__contains__, text.lower().split()))
+    return counts
+
+
+class BadWordMatcher(object):
+    """
+    Counts how many words of a bad word list appear in a comment, scanning the comment once whatever the list size.
+
+    A bad word `w` is counted when `' {} '.format(w).lower()` is a substring of the lowercased comment. Since the
+    only spaces of the comment are the ones between the pieces of `comment.lower().split(' ')`, that is exactly when
+    the pieces of `w` are a run of consecutive pieces which is neither at the start nor at the end of the comment.
+    The bad words are compiled into a trie over their pieces, so every position of the comment is matched against
+    all of them at once.
+    """
+
+    def __init__(self, badwords):
+        """
+        :param badwords: Iterable of bad words or phrases. Entries only differing by case are counted separately.
+        """
+        self.trie = {}
+        self.size = 0
+        for badword in badwords:
+            node = self.trie
+            for piece in ' {} '.format(badword).lower()[1:-1].split(' '):
+                node = node.setdefault(piece, {})
+            # The terminal holds an identifier of the lowercased word and the number of entries mapping to it
+            if None not in node:
+                node[None] = (self.size, 0)
+                self.size += 1
+            index, weight = node[None]
+            node[None] = (index, weight + 1)
+
+    def count(self, comment):
+        """
+        :param comment: A comment, anything else than a string (e.g. NaN) has no bad words
+        :return: Number of bad words appearing in the comment
+        """
+        if not isinstance(comment, str):
+            return 0
+        pieces = comment.lower().split(' ')
+        end = len(pieces) - 1
+        matched = {}
+        for start in range(1, end):
+            node = self.trie
+            for piece in pieces[start:end]:
+                node = node.get(piece)
+                if node is None:
+                    break
+                if None in node:
+                    index, weight = node[None]
+                    matched[index] = weight
+        return sum(matched.values())
+
+
+@lru_cache(maxsize=1)
+def english_stopwords():
+    """
+    :return: The set of NLTK english stopwords, loaded on first use. They are only downloaded if not installed yet.
+    """
+    from nltk.corpus import stopwords
+    nltk_data('corpora/stopwords', 'stopwords')
+    return set(stopwords.words("english"))
+
+
+def _sentiment_chunk(texts):
+    # Imported on first use since textblob is slow to import
+    from textblob import TextBlob
+    # A single analysis gives both scores
+    return [tuple(TextBlob(text).sentiment) for text in texts]
+
+
+def sentiment_scores(texts, cache=None, n_jobs=None, chunksize=1000):
+    """
+    Computes the TextBlob polarity and subjectivity of every comment.
+
+    Comments are keyed by a hash of their text, so every distinct comment is analysed only once and the scores of
+    comments found in `cache` are not recomputed. The remaining comments are analysed in chunks of `chunksize`
+    by a pool of processes.
+
+    :param texts: pd.Series of comments
+    :param cache: `utils.LRUCache` from text hash to (polarity, subjectivity), updated with the new scores
+    :param n_jobs: Number of worker processes. Defaults to all cores but one
+    :param chunksize: Number of comments sent to a worker at once
+    :return: Tuple of (polarity, subjectivity) np.ndarrays aligned with `texts`
+    """
+    cache = LRUCache() if cache is None else cache
+    keys = [hashlib.md5(text.encode('utf-8')).hexdigest() if isinstance(text, str) else None for text in texts]
+
+    # Every distinct comment is looked up once, so the hits and misses of the cache count distinct comments
+    found, missing = {}, {}
+    for key, text in zip(keys, texts):
+        # Anything else than a string is not cached, TextBlob raises the same error as before for it
+        if key is None or key in found or key in missing:
+            continue
+        score = cache.get(key)
+        if score is None:
+            missing[key] = text
+        else:
+            found[key] = score
+
+    if missing:
+        missing_texts = list(missing.values())
+        chunks = [missing_texts[i:i + chunksize] for i in range(0, len(missing_texts), chunksize)]
+        n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+        print("Analysing the sentiment of {} distinct comments".format(len(missing_texts)))
+        if n_jobs == 1 or len(chunks) == 1:
+            scores = [_sentiment_chunk(chunk) for chunk in chunks]
+        else:
+            pool = multiprocessing.Pool(processes=min(n_jobs, len(chunks)))
+            try:
+                scores = pool.map(_sentiment_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        computed = list(zip(missing.keys(), (score for chunk in scores for score in chunk)))
+        found.update(computed)
+        cache.update(computed)
+
+    scores = np.empty((len(keys), 2))
+    for i, (key, text) in enumerate(zip(keys, texts)):
+        scores[i] = found[key] if key is not None else _sentiment_chunk([text])[0]
+    return scores[:, 0], scores[:, 1]
+
+
+@lru_cache(maxsize=8)
+def load_bad_word_matcher(*paths_and_mtimes):
+    """
+    Builds the `BadWordMatcher` of the union of the bad word lists, which are assumed to hold the words in their
+    first column. The matcher is cached across calls, the modification times of the files are part of the key so
+    that it is rebuilt when the lists are edited.
+
+    :param paths_and_mtimes: Paths of the two csv files followed by their modification times
+    """
+    badwords_1_path, badwords_2_path = paths_and_mtimes[:2]
+    badwords_1 = pd.read_csv(badwords_1_path, 'utf-8', engine="python")
+    badwords_2 = pd.read_csv(badwords_2_path, sep=',')
+    badwords = set()
+    for df in (badwords_1, badwords_2):
+        badwords.update('{}'.format(x) for x in df[list(df)[0]])
+    return BadWordMatcher(badwords)
+
+
+def _init_feature_worker(adder):
+    _worker_state['adder'] = adder
+
+
+def _add_features_worker(args):
+    df, names = args
+    adder = _worker_state['adder']
+    return adder._add_features(df, [getattr(adder, name) for name in names])
+
 
 class FeatureAdder(object):
     def __init__(self, data_dir="data", upper_case=False, word_count=False, unique_words_count=False,
                  letter_count=False, punctuation_count=False, little_case=False,
-                 stopwords=False, question_or_exclamation=False, number_bad_words=False, sentiment_analysis=False):
+                 stopwords=False, question_or_exclamation=False, number_bad_words=False, sentiment_analysis=False,
+                 n_jobs=None, chunksize=10000, sentiment_cache_size=2 ** 20, compact=False):
 
         self.data_dir = data_dir
+        # Number of processes and rows per chunk used by `get_features`, `stream_features` and `sentiment_scores`
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+        self.sentiment_cache_size = sentiment_cache_size
+        # If True, counts are downcast to the smallest integer type holding them and scores to float32
+        self.compact = compact
         self.features = {
             self._upper: upper_case,
             self._count_words: word_count,
@@ -31,11 +238,213 @@ class FeatureAdder(object):
             self._count_bad_words: number_bad_words,
             self._polarity_subjectivity_score: sentiment_analysis
             }
+        # Extractors computed together by `count_word_features`, with the column each of them adds
+        self.word_features = {
+            self._upper: 'count_words_upper',
+            self._count_words: 'count_word',
+            self._unique_words: 'count_unique_word',
+            self._count_little_case: 'count_words_title',
+            self._count_stopwords: 'count_stopwords'
+            }
+        # Extractors which distribute their work to a pool of processes of their own, thus never run in a worker
+        self.pooled_features = [self._polarity_subjectivity_score]
+
+    def _add_word_feature(self, df, method):
+        column = self.word_features[method]
+        df[column] = count_word_features(df[TEXT_COLUMN], [column])[column]
+        return df
+
+    def add_features(self, df):
+        """
+        Adds all the activated features to the dataframe, in the order of the extractors.
+        The word based features are computed together in a single scan of the comments.
+
+        Parameters
+        -------------------------
+        df: pd.Dataframe, assumed to contain text in a column named `TEXT_COLUMN`
+
+        Returns
+        --------------------------
+        pd.Dataframe with the activated features as extra columns.
+        """
+        return self._add_features(df, self.enabled_features())
+
+    def enabled_features(self):
+        return [method for method, condition in self.features.items() if condition]
+
+    def _add_features(self, df, enabled):
+        counts = count_word_features(df[TEXT_COLUMN], [self.word_features[m] for m in enabled if m in self.word_features])
+        for method in enabled:
+            if method in self.word_features:
+                df[self.word_features[method]] = counts[self.word_features[method]]
+            else:
+                method(df)
+        return df
+
+    def _feature_pool(self, methods=None, n_rows=None):
+        """
+        :param methods: List of the extractors to run, all activated ones if None
+        :param n_rows: Number of rows to compute, if known
+        :return: The pool of processes computing row chunks with `_add_features_worker`. None if `n_jobs` is 1 or if
+                 `_compute_features` would not use it: all the extractors have a pool of their own or the rows fit
+                 in a single chunk.
+        """
+        methods = self.enabled_features() if methods is None else methods
+        n_jobs = self.n_jobs or max(1, multiprocessing.cpu_count() - 1)
+        if n_jobs == 1 or all(method in self.pooled_features for method in methods) or \
+                (n_rows is not None and n_rows <= self.chunksize):
+            return None
+        return multiprocessing.Pool(processes=n_jobs, initializer=_init_feature_worker, initargs=(self,))
+
+    def _compute_features(self, df, pool=None, methods=None):
+        """
+        Adds the given features to the dataframe, splitting it in row chunks of `chunksize` rows which are
+        computed by the processes of `pool`, if any. The output is identical to `add_features`.
+
+        :param methods: List of the extractors to run, in the order of `features`. All activated ones if None
+        :return: pd.Dataframe with the features as extra columns, not necessarily `df` itself
+        """
+        enabled = self.enabled_features() if methods is None else methods
+        if pool is None or len(df) <= self.chunksize:
+            return self._add_features(df, enabled)
+
+        names = [method.__name__ for method in enabled if method not in self.pooled_features]
+        chunks = [(df.iloc[i:i + self.chunksize], names) for i in range(0, len(df), self.chunksize)]
+        df = pd.concat(pool.map(_add_features_worker, chunks))
+        # The pooled extractors come last, so the columns are in the same order as with `add_features`
+        for method in enabled:
+            if method in self.pooled_features:
+                method(df)
+        return df
+
+    def _cached_features(self, df, cache, load, save):
+        """
+        Adds the activated features to the dataframe, loading the columns of the extractors cached for its comments
+        and only computing the missing ones.
+
+        :param df: pd.Dataframe, assumed to contain text in a column named `TEXT_COLUMN`
+        :param cache: `ArtifactCache` holding the columns of every extractor
+        :param load: If True, cached columns are used
+        :param save: If True, the computed columns are cached
+        :return: pd.Dataframe with the activated features in place of `TEXT_COLUMN`
+        """
+        enabled = self.enabled_features()
+        keys = {method: cache.key(df[TEXT_COLUMN], feature=method.__name__, **self._feature_inputs([method]))
+                for method in enabled}
+        cached = {}
+        for method in enabled:
+            entry = cache.get(keys[method]) if load else None
+            if entry is not None:
+                cached[method] = load_dense_frame(os.path.join(entry, 'columns'))
+
+        missing = [method for method in enabled if method not in cached]
+        if missing:
+            print('Computing {}, this will take a while...!'.format(', '.join(method.__name__ for method in missing)))
+            # The features only depend on the text, duplicate comments are computed once
+            index = DedupIndex(df[TEXT_COLUMN])
+            print('Extracting features of {}'.format(index))
+            pool = self._feature_pool(missing, len(index.unique))
+            try:
+                computed = self._compute_features(pd.DataFrame({TEXT_COLUMN: index.unique}), pool, missing)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            computed = index.scatter(computed)
+
+        df = df.drop(TEXT_COLUMN, axis=1)
+        for method in enabled:
+            if method in cached:
+                columns = cached[method]
+            else:
+                names = [name for name in FEATURE_COLUMNS[method.__name__] if name in computed]
+                if not names:
+                    # The extractor could not run, e.g. the bad words are missing
+                    continue
+                columns = computed[names]
+                if save:
+                    with cache.put(keys[method]) as entry:
+                        save_dense_frame(os.path.join(entry, 'columns'), columns)
+            for name in columns:
+                df[name] = columns[name].values
+        return df
+
+    def _feature_inputs(self, methods):
+        """
+        :param methods: List of extractors
+        :return: Dictionary describing the inputs of the extractors besides the comments, e.g. the bad word lists,
+                 to be part of the key of their cached columns
+        """
+        inputs = {}
+        if self._count_bad_words in methods:
+            inputs['badwords'] = [(path, os.path.getmtime(path) if os.path.exists(path) else None)
+                                  for path in self._bad_word_paths()]
+        return inputs
+
+    def _compact(self, df):
+        """Downcasts the feature columns of the dataframe if `compact` is set, see `utils.compact_frame`."""
+        if self.compact:
+            compact_frame(df, [name for names in FEATURE_COLUMNS.values() for name in names if name in df])
+        return df
+
+    def stream_features(self, chunks, name):
+        """
+        Computes the activated features of a dataset which does not fit in memory, given as an iterator of
+        DataFrame chunks. Every chunk is split further among the processes of the pool and its features are written
+        to the feature store as soon as they are computed, so memory is bounded by the size of the chunks.
+
+        Parameters
+        -------------------------
+        chunks: Iterable of pd.Dataframes, e.g. `pd.read_csv("data/train.csv", chunksize=100000)`
+        name: Name of the dataset, the features are written in `data_dir`/output/features/`name`
+
+        Returns
+        --------------------------
+        The directory holding the features, one frame per chunk, which can be read with `load_streamed_features`
+
+        Example
+        -------
+            >>> fa = FeatureAdder(upper_case=True, word_count=True, n_jobs=4)
+            >>> fa.stream_features(pd.read_csv("data/train.csv", chunksize=100000), 'train')
+            >>> train = fa.load_streamed_features('train', columns=['count_word'])
+        """
+        out_dir = os.path.join(self.data_dir, "output", "features", name)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+
+        pool = self._feature_pool()
+        try:
+            for i, chunk in enumerate(chunks):
+                chunk = self._compute_features(chunk, pool)
+                chunk.drop(TEXT_COLUMN, axis=1, inplace=True)
+                self._compact(chunk)
+                save_dense_frame(os.path.join(out_dir, 'part_{:05d}'.format(i)), chunk)
+                print('Saved the features of {} comments of chunk {}'.format(len(chunk), i))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return out_dir
+
+    def load_streamed_features(self, name, columns=None):
+        """
+        Loads the features written by `stream_features`.
+
+        :param name: Name of the dataset given to `stream_features`
+        :param columns: List of the feature columns to be loaded, all of them if None
+        :return: pd.Dataframe holding the features of all chunks
+        """
+        out_dir = os.path.join(self.data_dir, "output", "features", name)
+        parts = sorted(part for part in os.listdir(out_dir) if part.startswith('part_'))
+        return pd.concat([load_dense_frame(os.path.join(out_dir, part), columns) for part in parts], ignore_index=True)
 
     def _polarity_subjectivity_score(self, df):
         """
         This method calculates the polarity and subjetivity score. Both metrics are used to
         evaluate the sentiment of a text.
+        The scores are cached in `data_dir`/output/sentiment.pkl, keyed by a hash of the comments, so duplicate
+        comments and later runs are not analysed again.
         Parameters
         -------------------------
         df: Pandas Dataframe. Assumed to contain text in a column named `TEXT_COLUMN`
@@ -43,19 +452,29 @@ class FeatureAdder(object):
         --------------------------
         df: Data frame with the polarity and sbjectivity score
         """
-        def polarity_score(x):
-            return TextBlob(x).sentiment.polarity
+        cache_path = os.path.join(self.data_dir, "output", "sentiment.pkl")
+        if os.path.exists(cache_path):
+            cache = LRUCache.load(cache_path, self.sentiment_cache_size)
+        else:
+            cache = LRUCache(self.sentiment_cache_size)
 
-        def subjectivity_score(x):
-            return TextBlob(x).sentiment.subjectivity
+        polarity, subjectivity = sentiment_scores(df[TEXT_COLUMN], cache, self.n_jobs, self.chunksize)
+        print("Sentiment cache: {}".format(cache))
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        cache.save(cache_path)
 
-        df['polarity_score'] = df[TEXT_COLUMN].apply(lambda x: polarity_score(x))
-        df['subjectivity_score'] = df[TEXT_COLUMN].apply(lambda x: subjectivity_score(x))
+        df['polarity_score'] = polarity
+        df['subjectivity_score'] = subjectivity
         return df
 
     def set_path(self, data_dir):
         self.data_dir = data_dir
 
+    def _bad_word_paths(self):
+        return (os.path.join(self.data_dir, "badwords", "google_bad_words.csv"),
+                os.path.join(self.data_dir, "badwords", "bad_words.csv"))
+
     def _count_bad_words(self, df):
         """
         This is a method that creates a new feature with the number of words in the google bad list.
@@ -68,33 +487,17 @@ class FeatureAdder(object):
         df: Data frame with the number of the bad words according to the google dictionary.
         """
 
-        def union_sets(*dfs):
-            final = set()
-            for df in dfs:
-                s = set(df[list(df)[0]])  # Assuming that curse words are the 1st column
-                final = final.union(s)
-            return [' {} '.format(x) for x in final]
-
-        def count_badwords(comment):
-            try:
-                return sum(badword.lower() in comment.lower() for badword in badwords)
-            except AttributeError:
-                # Bad comment, probably NaN
-                return 0
-
-        badwords_1_path = os.path.join(self.data_dir, "badwords", "google_bad_words.csv")
-        badwords_2_path = os.path.join(self.data_dir, "badwords", "bad_words.csv")
+        badwords_1_path, badwords_2_path = self._bad_word_paths()
 
         try:
-            badwords_1 = pd.read_csv(badwords_1_path, 'utf-8', engine="python")
-            badwords_2 = pd.read_csv(badwords_2_path, sep=',')
+            matcher = load_bad_word_matcher(badwords_1_path, badwords_2_path,
+                                            os.path.getmtime(badwords_1_path), os.path.getmtime(badwords_2_path))
         except FileNotFoundError:
             print("Could not find the badwords folder at {}\n"
                   "Please provide the data root path using the `set_path` method.".format(self.data_dir))
             return None
 
-        badwords = union_sets(badwords_1, badwords_2)
-        df["count_bad_words"] = df[TEXT_COLUMN].apply(count_badwords)
+        df["count_bad_words"] = df[TEXT_COLUMN].apply(matcher.count)
         return df
 
     def _upper(self, df):
@@ -109,8 +512,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of the capitalized words as an extra feature.
         """
-        df["count_words_upper"] = df[TEXT_COLUMN].apply(lambda x: len([w for w in str(x).split() if w.isupper()]))
-        return df
+        return self._add_word_feature(df, self._upper)
 
     def _count_words(self, df):
         """
@@ -124,8 +526,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of words as an extra feature.
         """
-        df['count_word'] = df[TEXT_COLUMN].apply(lambda x: len(str(x).split()))
-        return df
+        return self._add_word_feature(df, self._count_words)
 
     def _unique_words(self, df):
         """
@@ -139,8 +540,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of the unique words as an extra feature.
         """
-        df['count_unique_word'] = df[TEXT_COLUMN].apply(lambda x: len(set(str(x).split())))
-        return df
+        return self._add_word_feature(df, self._unique_words)
 
     def _count_letters(self, df):
         """
@@ -154,7 +554,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the aggregated number of the characters as an extra feature.
         """
-        df['count_letters'] = df[TEXT_COLUMN].apply(lambda x: len(str(x)))
+        df['count_letters'] = df[TEXT_COLUMN].map(str).str.len()
         return df
 
     def _count_punctuation(self, df):
@@ -169,8 +569,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of the puncutation symbols as an extra feature.
         """
-        df["count_punctuations"] = df[TEXT_COLUMN].apply(
-            lambda x: len([c for c in str(x) if c in string.punctuation]))
+        df["count_punctuations"] = df[TEXT_COLUMN].map(str).str.count(PUNCTUATION_PATTERN)
         return df
 
     def _count_little_case(self, df):
@@ -185,8 +584,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of the not capitalized words as an extra feature.
         """
-        df["count_words_title"] = df[TEXT_COLUMN].apply(lambda x: len([w for w in str(x).split() if w.islower()]))
-        return df
+        return self._add_word_feature(df, self._count_little_case)
 
     def _count_stopwords(self, df):
         """
@@ -200,9 +598,7 @@ class FeatureAdder(object):
         --------------------------
         pd.Dataframe with the number of the stop words (like 'then', 'to', 'a' etc) as an extra feature.
         """
-        df["count_stopwords"] = df[TEXT_COLUMN].apply(
-            lambda x: len([w for w in str(x).lower().split() if w in eng_stopwords]))
-        return df
+        return self._add_word_feature(df, self._count_stopwords)
 
     def _question_or_exclamation(self, df):
         """
@@ -221,15 +617,23 @@ class FeatureAdder(object):
         return df
 
     @timing
-    def get_features(self, train=None, test=None, save=False, load=True):
+    def get_features(self, train=None, test=None, save=False, load=True, cache_size=CACHE_SIZE_DEFAULT):
         """
         Call feature extractors that have been activated (by setting their boolean attribute to True)
 
+        The features are cached under `data_dir`/output/cache keyed by a hash of the input data and of the activated
+        extractors, so different sets of features are kept side by side. The columns of every extractor are also
+        cached on their own, keyed by a hash of the comments, so activating a new extractor only computes that one.
+        Unless `n_jobs` is 1, the rows are split in chunks of `chunksize` rows computed by a pool of processes.
+        For datasets which do not fit in memory see `stream_features`.
+
         Parameters
         -------------------------
         train, test: pd.Dataframes to go through the transformation
         save: boolean. True to save the train and test data set in your local machine
-        load: boolean. True to get the train and test set from your local machine
+        load: boolean. True to get the train and test set from your local machine if they have been computed before.
+              If train and test are not provided, the features saved last are loaded.
+        cache_size: Maximum size of the cache on disk in bytes, least recently used entries are evicted beyond it
 
         Returns
         --------------------------
@@ -251,37 +655,39 @@ class FeatureAdder(object):
             >>> train, test = fa.get_features(load=True)
 
         """
-        base_dir = self.data_dir + "/output"
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
+        cache = ArtifactCache(os.path.join(self.data_dir, "output", "cache"), max_size=cache_size)
+        name_train, name_test = 'df_train_features_added', 'df_test_features_added'
 
-        name_train = base_dir + '/df_train_features_added.csv'
-        name_test = base_dir + '/df_test_features_added.csv'
+        def read(entry):
+            return self._compact(load_dense_frame(os.path.join(entry, name_train))), \
+                self._compact(load_dense_frame(os.path.join(entry, name_test)))
 
-        if load:
-            if os.path.exists(name_train) and os.path.exists(name_test):
-                print('getting files from your local machine')
-                train, test = pd.read_csv(name_train), pd.read_csv(name_test)
-            else:
+        if train is None or test is None:
+            entry = cache.latest('features') if load else None
+            if entry is None:
                 raise ValueError("You asked to load the features but they were not found " +
-                                 "at the specified location: \n{}\n{}".format(name_train, name_test))
-        else:
-            print('Computing the new features, this will take a while...!')
-            for method, condition in self.features.items():
-                if condition:
-                    method(train), method(test)
+                                 "at the specified location: \n{}".format(cache.cache_dir))
+            print('getting files from your local machine')
+            return read(entry)
+
+        enabled = self.enabled_features()
+        key = cache.key(train, test, features=[method.__name__ for method in enabled], **self._feature_inputs(enabled))
+        entry = cache.get(key) if load else None
+        if entry is not None:
+            print('getting files from your local machine')
+            return read(entry)
 
-            train.drop(TEXT_COLUMN, axis=1, inplace=True)
-            test.drop(TEXT_COLUMN, axis=1, inplace=True)
+        train = self._cached_features(train, cache, load, save)
+        test = self._cached_features(test, cache, load, save)
 
         if save:
-            print('Saving train file as {}'.format(name_train))
-            train.to_csv(name_train, index=False)
-            print('Saving test file as {}'.format(name_test))
-            test.to_csv(name_test, index=False)
-            print('Files saved')
+            with cache.put(key, name='features') as entry:
+                print('Saving train and test files in {}'.format(entry))
+                save_dense_frame(os.path.join(entry, name_train), train)
+                save_dense_frame(os.path.join(entry, name_test), test)
+                print('Files saved')
 
-        return train, test
+        return self._compact(train), self._compact(test)
 
 
 if __name__ == "__main__":
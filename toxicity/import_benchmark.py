@@ -0,0 +1,49 @@
+"""
+Measures how long importing every toxicity module takes, each in a fresh interpreter so that nothing is cached.
+
+Usage: python import_benchmark.py [--repeat N] [module ...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+MODULES = ['utils', 'cache', 'tokenizer', 'preprocessing', 'feature_adder', 'predictor', 'linear_predictor', 'tuning',
+           'ensembler']
+
+# Prints the import time of a module and the number of modules it loaded
+SNIPPET = "import sys, time; start = time.time(); import {}; print(time.time() - start, len(sys.modules))"
+
+
+def import_time(module, repeat=3):
+    """
+    :param module: Name of the module to be imported
+    :param repeat: Number of fresh interpreters importing the module
+    :return: Tuple of (best import time in seconds, number of modules loaded), or None if the import fails
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', SNIPPET.format(module)], cwd=cwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        seconds, loaded = result.stdout.strip().split('\n')[-1].split()
+        if best is None or float(seconds) < best[0]:
+            best = (float(seconds), int(loaded))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:<20}{:>12}{:>12}".format('module', 'seconds', 'modules'))
+    for module in args.modules:
+        timing = import_time(module, args.repeat)
+        if timing is None:
+            print("{:<20}{:>12}".format(module, 'failed'))
+        else:
+            print("{:<20}{:>12.3f}{:>12}".format(module, *timing))
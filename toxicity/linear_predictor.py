@@ -3,11 +3,36 @@ import multiprocessing
 from sklearn.linear_model import LogisticRegression
 from sklearn.svm import LinearSVC
 from sklearn.ensemble import RandomForestClassifier
-try:
-    from xgboost import XGBClassifier
-except ImportError:
-    print("XGBoost not imported.")
+from sklearn.base import clone
+from sklearn.metrics import roc_auc_score
 from predictor import Predictor
+from utils import label_matrix
+
+
+def nb_ratios(x, labels):
+    """
+    Computes the naive Bayes log-count ratios of the features for many binary labels at once.
+
+    The feature sums of the positive samples of every label come from a single sparse product of the label matrix
+    with `x`, those of the negative samples are the total sums minus them. Unlike masking the rows of `x` for every
+    label and class, this never copies `x`.
+
+    :param x: Sparse matrix of shape (n_samples, n_features)
+    :param labels: Binary array of shape (n_samples, n_labels)
+    :return: np.ndarray of shape (n_labels, n_features), one row of ratios per label
+    """
+    labels = np.asarray(labels, dtype=np.float64).reshape(x.shape[0], -1)
+    positives = np.asarray(x.T.dot(labels)).T
+    negatives = np.asarray(x.sum(0)) - positives
+    n_positives = labels.sum(0)[:, None]
+    n_negatives = x.shape[0] - n_positives
+    return np.log(((positives + 1) / (n_positives + 1)) / ((negatives + 1) / (n_negatives + 1)))
+
+
+def _fit_nb_model(x, model, r, y, params):
+    """Fits a logistic model on the features scaled by the naive Bayes ratios of its tag."""
+    model.fit(x.multiply(r), y, **params)
+    return model
 
 
 class LogisticPredictor(Predictor):
@@ -46,6 +71,8 @@ class LogisticPredictor(Predictor):
 
         # Used for internal representation
         self.r = None
+        # Ratios of every tag, see `fit_all`
+        self.rs = None
 
     def fit(self, train_x, train_y, **params):
         """
@@ -55,14 +82,53 @@ class LogisticPredictor(Predictor):
         :param train_y Contains the dependent tag values
         """
 
-        def pr(y_i):
-            p = train_x[train_y == y_i].sum(0)
-            return (p + 1) / ((train_y == y_i).sum() + 1)
-
-        self.r = np.log(pr(1) / pr(0))
+        self.r = nb_ratios(train_x, train_y)
         nb = train_x.multiply(self.r)
         self.model.fit(nb, train_y, **params)
 
+    def fit_all(self, train_x, train_ys, n_jobs=None, **params):
+        """
+        Fits one model per tag, see `Predictor.fit_all`. The naive Bayes ratios of all tags are computed together,
+        see `nb_ratios`, and the logistic models are fitted in parallel.
+
+        :param train_x: Contains the input features
+        :param train_ys: Dictionary mapping every tag to its values, or an array of shape (n_samples, len(TAGS))
+        :param n_jobs: Number of processes fitting the tags, all cores but one if None
+        """
+        labels = label_matrix(train_ys)
+        self.rs = nb_ratios(train_x, labels)
+        tasks = [(clone(self.model), self.rs[tag:tag + 1], labels[:, tag], params) for tag in range(labels.shape[1])]
+        self.tag_models = self._map_tags(_fit_nb_model, tasks, train_x, n_jobs)
+
+    def predict_proba_all(self, test_x):
+        """
+        :param test_x: a (potentially sparse) array of shape: (n_samples, n_features)
+        :return: The predicted probabilities of every tag fitted by `fit_all`, of shape (n_samples, len(TAGS))
+        """
+        return np.column_stack([model.predict_proba(test_x.multiply(self.rs[tag:tag + 1]))[:, 1]
+                                for tag, model in enumerate(self.tag_models)])
+
+    def score_path(self, train_x, train_y, val_x, val_y, param, values):
+        """
+        Fits the regularization path of `C`, see `Predictor.score_path`. The naive Bayes ratios do not depend on `C`,
+        so the scaled matrices are computed once, and every model is warm started from the solution of the previous
+        value. Note that the 'liblinear' solver does not support warm starting and always starts from zero.
+        """
+        if param != 'C':
+            return super().score_path(train_x, train_y, val_x, val_y, param, values)
+
+        r = nb_ratios(train_x, train_y)
+        train_nb = train_x.multiply(r).tocsr()
+        val_nb = val_x.multiply(r).tocsr()
+
+        model = clone(self.model).set_params(warm_start=True)
+        scores = []
+        for C in values:
+            model.set_params(C=C)
+            model.fit(train_nb, train_y)
+            scores.append(roc_auc_score(val_y, model.predict_proba(val_nb)[:, 1]))
+        return scores
+
     def predict_proba(self, test_x):
         """
         Predicts the label for the given input
@@ -193,6 +259,8 @@ class XGBPredictor(Predictor):
                  subsample=1, colsample_bytree=1, colsample_bylevel=1, reg_alpha=0, reg_lambda=1, scale_pos_weight=1,
                  base_score=0.5, seed=0, missing=None, name=name):
         super().__init__(name=name)
+        # Imported on first use, xgboost is optional and slow to import
+        from xgboost import XGBClassifier
         self.model = XGBClassifier(max_depth=int(max_depth), learning_rate=learning_rate, n_estimators=n_estimators,
                                    silent=silent, objective=objective,
                                    gamma=gamma, min_child_weight=min_child_weight, max_delta_step=max_delta_step,
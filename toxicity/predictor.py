@@ -1,15 +1,105 @@
 from abc import abstractmethod
+import multiprocessing
 import numpy as np
 from collections import Counter
 from sklearn.metrics import roc_auc_score
-from sklearn.model_selection import train_test_split, cross_val_score, StratifiedShuffleSplit
-from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.model_selection import train_test_split, StratifiedKFold, StratifiedShuffleSplit
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 
-from utils import timing, TAGS
+from utils import timing, label_matrix, TAGS
+from cache import FoldCache
 
 TUNING_OUTPUT_DEFAULT = 'tuning.txt'
 RANDOM_STATE = 42  # Used for reproducible results
 
+# The folds of the evaluations, shared by all the predictors evaluated in this process
+FOLD_CACHE = FoldCache()
+
+# Used by the worker processes of `Predictor._fold_scores` and `Predictor._map_tags`, set once per process by
+# `_init_fold_worker` and `_init_tag_worker`
+_worker_state = {}
+
+
+def make_splits(x, ys, method, nfolds=3, val_size=0.3):
+    """
+    Splits the rows of the training set for the evaluation methods of `Predictor.evaluate`, see `Folds`.
+
+    :param x: Input features
+    :param ys: Dictionary mapping a tag with its true labels
+    :param method: One of 'stratified_CV', 'CV' or 'split'
+    :param nfolds: Number of folds of the CV methods
+    :param val_size: Ratio of the training set used as validation by the split method
+    :return: Tuple (rows, splits). `rows` is None or the index of the rows being split, `splits` is a list of tuples
+             (tags, train_index, val_index) where `tags` are the tags evaluated on the split
+    """
+    if method == 'CV':
+        # The same folds as `cross_val_score(predictor, x, ys[tag], cv=nfolds)`
+        return None, [((tag,), train_index, val_index) for tag in TAGS
+                      for train_index, val_index in StratifiedKFold(n_splits=nfolds).split(np.zeros(len(ys[tag])), ys[tag])]
+
+    if method == 'split':
+        # The rows of `train_test_split(x, ys[tag], test_size=val_size, random_state=RANDOM_STATE)`, for every tag
+        train_index, val_index = train_test_split(np.arange(x.shape[0]), test_size=val_size, random_state=RANDOM_STATE)
+        return None, [(tuple(TAGS), train_index, val_index)]
+
+    if method == 'stratified_CV':
+        # In order to use stratified CV we transform the multi-label problem into a single label, multi-class one.
+        # This is achieved by converting each label set to a single label, using bin -> dec conversion.
+        y = label_matrix(ys).dot([2 ** i for i in range(0, len(TAGS))])
+
+        # Remove rare labels
+        c = Counter(y)
+        rows = np.array([i for i, label in enumerate(y) if c[label] >= 5], dtype=np.int64)
+
+        splitter = StratifiedShuffleSplit(n_splits=nfolds, random_state=RANDOM_STATE)
+        return rows, [(tuple(TAGS), train_index, val_index) for train_index, val_index in splitter.split(rows, y[rows])]
+
+    raise ValueError("Method must be either 'stratified_CV', 'CV' or 'split', not {}".format(method))
+
+
+def _init_fold_worker(predictor, x, ys, folds):
+    _worker_state['args'] = (predictor, x, ys, folds)
+
+
+def _fold_score(task):
+    """Fits the predictor on the train rows of a fold for one tag and returns its AUC on the validation rows."""
+    predictor, x, ys, folds = _worker_state['args']
+    tag, fold = task
+    (train_x, val_x), (train_index, val_index) = folds.features(x, fold), folds.indices(fold)
+    predictor.fit(train_x, ys[tag][train_index])
+    return roc_auc_score(ys[tag][val_index], predictor.predict_proba(val_x))
+
+
+def _fold_path_scores(task):
+    """Fits the predictor on the train rows of a fold for one tag and every value of a parameter, see `score_path`."""
+    predictor, x, ys, folds = _worker_state['args']
+    tag, fold, param, values = task
+    (train_x, val_x), (train_index, val_index) = folds.features(x, fold), folds.indices(fold)
+    return predictor.score_path(train_x, ys[tag][train_index], val_x, ys[tag][val_index], param, values)
+
+
+def _fold_scores_all_tags(task):
+    """Fits the predictor on the train rows of a fold for all tags and returns their AUC on the validation rows."""
+    predictor, x, ys, folds = _worker_state['args']
+    (train_x, val_x), (train_index, val_index) = folds.features(x, task), folds.indices(task)
+    predictor.fit_all(train_x, ys[train_index], n_jobs=1)
+    predictions = predictor.predict_proba_all(val_x)
+    return [roc_auc_score(ys[val_index, tag], predictions[:, tag]) for tag in range(ys.shape[1])]
+
+
+def _init_tag_worker(x):
+    _worker_state['x'] = x
+
+
+def _run_tag_task(task):
+    function, args = task[0], task[1:]
+    return function(_worker_state['x'], *args)
+
+
+def _fit_predictor(x, predictor, y):
+    predictor.fit(x, y)
+    return predictor
+
 
 class Predictor(BaseEstimator, ClassifierMixin):
     """
@@ -28,6 +118,8 @@ class Predictor(BaseEstimator, ClassifierMixin):
         :param name: Optional model name, used for logging
         """
         self.name = name
+        # Fitted copies of the predictor, one per tag, see `fit_all`
+        self.tag_models = None
 
     def __str__(self):
         return self.name
@@ -57,54 +149,117 @@ class Predictor(BaseEstimator, ClassifierMixin):
         :return: The predicted probabilities
         """
 
-    def _stratified_cv(self, x, ys, nfolds):
-        # In order to use stratified CV we transform the multi-label problem into a single label, multi-class one.
-        # This is achieved by converting each label set to a single label, using bin -> dec conversion.
-        def convert_label(label):
-            """
-            Translates a set of labels into a single label using binary to decimal conversion
-            """
-            mul = [2 ** i for i in range(0, len(TAGS))]
-            return np.dot(mul, label)
-
-        def delete(arr, indices):
-            """
-            Delete rows from a sparse matrix by index
-            """
-            mask = np.ones(arr.shape[0], dtype=bool)
-            mask[indices] = False
-            return arr[mask]
-
-        # Multi label to single label
-        ys = np.array([ys[i] for i in TAGS]).T
-        y = np.apply_along_axis(convert_label, 1, ys)
+    def fit_all(self, train_x, train_ys, n_jobs=None):
+        """
+        Fits the predictor to all tags at once, one copy of the predictor per tag. The tags are fitted in parallel.
+        Predictors sharing work across tags override it, along with `predict_proba_all`.
 
-        # Remove rare labels
-        c = Counter(y)
-        bad_indices = []
-        for i, label in enumerate(y):
-            if c[label] < 5:
-                bad_indices.append(i)
-        x = delete(x, bad_indices)
-        y = delete(y, bad_indices)
+        :param train_x: Contains the input features
+        :param train_ys: Dictionary mapping every tag to its values, or an array of shape (n_samples, len(TAGS))
+        :param n_jobs: Number of processes fitting the tags, all cores but one if None
+        """
+        labels = label_matrix(train_ys)
+        tasks = [(clone(self), labels[:, tag]) for tag in range(labels.shape[1])]
+        self.tag_models = self._map_tags(_fit_predictor, tasks, train_x, n_jobs)
 
-        splitter = StratifiedShuffleSplit(n_splits=nfolds, random_state=RANDOM_STATE)
+    def predict_proba_all(self, test_x):
+        """
+        Predicts the probabilities of all the tags fitted by `fit_all`
+        :param test_x: a pd.DataFrame of features to be used for predictions
+        :return: The predicted probabilities, of shape (n_samples, len(TAGS))
+        """
+        return np.column_stack([predictor.predict_proba(test_x) for predictor in self.tag_models])
+
+    @staticmethod
+    def _map_tags(function, tasks, x, n_jobs=None):
+        """
+        Runs `function(x, *task)` for every task, in a pool of processes unless `n_jobs` is 1.
+        The features are handed to every process once when it starts, instead of once per task.
+
+        :return: List of the results, in the order of `tasks`
+        """
+        n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+        if n_jobs == 1:
+            return [function(x, *task) for task in tasks]
+
+        pool = multiprocessing.Pool(processes=min(n_jobs, len(tasks)), initializer=_init_tag_worker, initargs=(x,))
+        try:
+            return pool.map(_run_tag_task, [(function,) + tuple(task) for task in tasks], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def score_path(self, train_x, train_y, val_x, val_y, param, values):
+        """
+        Fits the predictor for every value of one of its parameters and scores it on the validation set.
+        Predictors able to reuse work between the values override it, e.g. by warm starting.
+
+        :param train_x: Input features to be used for fitting
+        :param train_y: Labels to be used for fitting
+        :param val_x: Input features to be used for validation
+        :param val_y: Labels to be used for validation
+        :param param: Name of the parameter
+        :param values: Values of the parameter, in the order they are fitted
+        :return: List of the AUC of every value
+        """
         scores = []
-        for train_index, val_index in splitter.split(x, y):
-            train_x, val_x = x[train_index], x[val_index]
-            train_ys, val_ys = ys[train_index, :], ys[val_index, :]
+        for value in values:
+            predictor = type(self)(**dict(self.get_params(), **{param: value}))
+            predictor.fit(train_x, train_y)
+            scores.append(roc_auc_score(val_y, predictor.predict_proba(val_x)))
+        return scores
+
+    def _fold_scores(self, predictor, x, ys, folds, tasks, n_jobs=1, score=_fold_score):
+        """
+        Computes the AUC of every (tag, fold) task, see `_fold_score`, of every fold with `score=_fold_scores_all_tags`,
+        or of every (tag, fold, param, values) task with `score=_fold_path_scores`.
+
+        The tasks are independent, so unless `n_jobs` is 1 they are distributed to a pool of processes. The features
+        and folds are handed to every process once when it starts, instead of once per task.
+
+        :param predictor: The predictor fitted by the tasks
+        :param x: Input features
+        :param ys: Dictionary mapping a tag with its true labels
+        :param folds: The `Folds` of the features
+        :param tasks: List of tasks, whose folds are given by their number in `folds`
+        :param n_jobs: Number of processes, all cores but one if None
+        :return: List of the AUC of every task, in the order of `tasks`
+        """
+        n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+        if n_jobs == 1:
+            _init_fold_worker(predictor, x, ys, folds)
+            try:
+                return [score(task) for task in tasks]
+            finally:
+                _worker_state.clear()
+
+        pool = multiprocessing.Pool(processes=min(n_jobs, len(tasks)), initializer=_init_fold_worker,
+                                    initargs=(predictor, x, ys, folds))
+        try:
+            return pool.map(score, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
-            losses = []
-            for tag in range(0, len(TAGS)):
-                self.fit(train_x, train_ys[:, tag])
-                predictions = self.predict_proba(val_x)
-                losses.append(roc_auc_score(val_ys[:, tag], predictions))
-            scores.append(np.mean(losses))
+    @staticmethod
+    def folds(x, ys, method, nfolds=3, val_size=0.3, fold_cache=None):
+        """
+        :param fold_cache: The `FoldCache` holding the folds, `FOLD_CACHE` if None
+        :return: The `Folds` of the evaluation method, see `make_splits`
+        """
+        fold_cache = fold_cache or FOLD_CACHE
+        return fold_cache.folds(x, ys, make_splits, method=method, nfolds=nfolds, val_size=val_size)
 
+    def _stratified_cv(self, x, ys, nfolds, n_jobs=1, fold_cache=None):
+        folds = self.folds(x, ys, 'stratified_CV', nfolds, fold_cache=fold_cache)
+        losses = self._fold_scores(self, x, label_matrix(ys), folds, list(range(len(folds))), n_jobs,
+                                   score=_fold_scores_all_tags)
+
+        scores = [np.mean(fold_losses) for fold_losses in losses]
         return np.mean(scores)
 
     @timing
-    def evaluate(self, x, ys, method="CV", nfolds=3, val_size=0.3):
+    def evaluate(self, x, ys, method="CV", nfolds=3, val_size=0.3, n_jobs=1, fold_cache=None):
         """
         Evaluate performance of the predictor. The default method `CV` is a lot more robust, however it is also a lot slower
         since it goes through `nfolds * len(TAGS)` iterations. The `split` method is based on a train-test split which makes it a lot faster.
@@ -114,27 +269,56 @@ class Predictor(BaseEstimator, ClassifierMixin):
         :param method: String denoting the evaluation method. Acceptable values are cv for cross validation and split for train-test split
         :param nfolds: Number of folds per tag in case CV is the evaluation method. Ignored otherwise
         :param val_size: Ratio of the training set to be used as validation in case split is the evaluation method. Ignored otherwise
+        :param n_jobs: Number of processes fitting the models of every tag and fold, all cores but one if None. Keep
+                       it to 1 when evaluating from a worker process, e.g. in `tuning`. The result does not depend on it.
+        :param fold_cache: The `FoldCache` holding the folds, shared by all the predictors. `FOLD_CACHE` if None.
         :return: The average log loss error across all tags
         """
         print("Using {} evaluation method across all tags...".format(method))
         if method == 'stratified_CV':
-            return self._stratified_cv(x, ys, nfolds)
+            return self._stratified_cv(x, ys, nfolds, n_jobs, fold_cache)
+
+        folds = self.folds(x, ys, method, nfolds, val_size, fold_cache)
+        tasks = [(tag, fold) for fold in range(len(folds)) for tag in folds.tags(fold)]
+        # The CV method fits a clone of the predictor, like `cross_val_score`
+        scores = self._fold_scores(clone(self) if method == 'CV' else self, x, ys, folds, tasks, n_jobs)
 
         losses = []
-        if method == 'CV':
-            for tag in TAGS:
-                print("Evaluating tag {}".format(tag))
-                scores = cross_val_score(self, x, ys[tag], cv=nfolds)
-                losses.append(np.mean(scores))
-            return np.mean(losses)
-
-        if method == 'split':
-            for tag in TAGS:
-                train_x, val_x, train_y, val_y = train_test_split(x, ys[tag], test_size=val_size,
-                                                                  random_state=RANDOM_STATE)
-                self.fit(train_x, train_y)
-                predictions = self.predict_proba(val_x)
-                losses.append(roc_auc_score(val_y, predictions))
-            return np.mean(losses)
-
-        raise ValueError("Method must be either 'stratified_CV', 'CV' or 'split', not {}".format(method))
+        for tag in TAGS:
+            losses.append(np.mean([score for (task_tag, _), score in zip(tasks, scores) if task_tag == tag]))
+            if method == 'CV':
+                print("Tag {}: AUC {:.5f}".format(tag, losses[-1]))
+        return np.mean(losses)
+
+    @timing
+    def evaluate_path(self, x, ys, param, values, method="split", nfolds=3, val_size=0.3, n_jobs=1, fold_cache=None):
+        """
+        Evaluates the predictor for every value of one of its parameters, e.g. the regularization path of `C`.
+        Uses the same splits as `evaluate`, but the values are fitted together per tag and fold, see `score_path`.
+        Predictors fitting every value from scratch, e.g. `LogisticPredictor` with the 'liblinear' solver, get the
+        scores `evaluate` returns for every value. Warm started solvers converge to slightly different models, so
+        their scores only agree with `evaluate` up to the tolerance of the solver.
+
+        :param x: Input features to be used for fitting
+        :param ys: Dictionary mapping a tag with its true labels
+        :param param: Name of the parameter
+        :param values: Values of the parameter, they are fitted in increasing order
+        :param method: Either 'CV' or 'split', see `evaluate`
+        :param nfolds: Number of folds per tag in case CV is the evaluation method. Ignored otherwise
+        :param val_size: Ratio of the training set to be used as validation in case split is the evaluation method. Ignored otherwise
+        :param n_jobs: Number of processes fitting the folds, all cores but one if None
+        :param fold_cache: The `FoldCache` holding the folds, `FOLD_CACHE` if None
+        :return: List of tuples (value, average AUC across all tags), sorted by value
+        """
+        values = sorted(values)
+        print("Using {} evaluation method across all tags for {} values of {}...".format(method, len(values), param))
+        if method not in ('CV', 'split'):
+            raise ValueError("Method must be either 'CV' or 'split', not {}".format(method))
+
+        folds = self.folds(x, ys, method, nfolds, val_size, fold_cache)
+        tasks = [(tag, fold, param, values) for fold in range(len(folds)) for tag in folds.tags(fold)]
+        scores = np.array(self._fold_scores(clone(self), x, ys, folds, tasks, n_jobs, score=_fold_path_scores))
+
+        # Average the folds of every tag, then the tags
+        losses = [scores[[i for i, task in enumerate(tasks) if task[0] == tag]].mean(axis=0) for tag in TAGS]
+        return list(zip(values, np.mean(losses, axis=0)))
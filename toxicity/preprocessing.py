@@ -1,12 +1,15 @@
 import pandas as pd
 import numpy as np
-import nltk
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
 from sklearn.decomposition import TruncatedSVD
-from gensim import corpora, models
 
-from utils import timing, save_sparse_csr, load_sparse_csr
+from utils import timing, save_sparse_csr, load_sparse_csr, fingerprint, save_dense_frame, DedupIndex
+from cache import ArtifactCache, CACHE_SIZE_DEFAULT
+from tokenizer import Tokenizer, tokenize_corpus, load_or_tokenize, pretokenized_params, token_store_dir
 import os
+import multiprocessing
 
 
 def check_compatibility(f):
@@ -24,21 +27,59 @@ def check_compatibility(f):
     return wrap
 
 
+def remove_numbers_helper(s):
+    """Removes numbers from every comment of a pd.Series."""
+    return s.apply(lambda s: ''.join([i for i in s if not i.isdigit()]))
+
+
 def remove_numbers(train, test):
     """Removes numbers - who would have guessed!"""
-    def remove_numbers_helper(s):
-        return s.apply(lambda s: ''.join([i for i in s if not i.isdigit()]))
-
     train["comment_text"] = remove_numbers_helper(train["comment_text"])
     test["comment_text"] = remove_numbers_helper(test["comment_text"])
     return train, test
 
 
+class ChainedCorpus(object):
+    """
+    Lazy concatenation of gensim corpora. Unlike `itertools.chain` it can be iterated over many times,
+    which the models need, and unlike adding lists it never holds the documents in memory.
+    """
+
+    def __init__(self, *corpora):
+        self.corpora = corpora
+
+    def __iter__(self):
+        for corpus in self.corpora:
+            for doc in corpus:
+                yield doc
+
+    def __len__(self):
+        return sum(len(corpus) for corpus in self.corpora)
+
+
+def topics_to_dense(topics, num_topics, num_docs=None):
+    """
+    Converts the output of a gensim model into a dense matrix, streaming the topic weights of every document
+    straight into a preallocated array. Topics missing from a document's sparse vector (e.g. in LDA) get a weight of 0.
+
+    :param topics: Iterable over documents, each being a list of (topic_id, weight) tuples
+    :param num_topics: Number of columns of the output
+    :param num_docs: Number of documents, required if `topics` has no length
+    :return: np.ndarray of shape (num_docs, num_topics) and dtype float32
+    """
+    dense = np.zeros((num_docs if num_docs is not None else len(topics), num_topics), dtype=np.float32)
+    for i, doc in enumerate(topics):
+        if doc:
+            ids, weights = zip(*doc)
+            dense[i, list(ids)] = weights
+    return dense
+
+
 @check_compatibility
 @timing
 def gensim_preprocess(train, test, model_type='lsi', num_topics=500,
                       use_own_tfidf=False, force_compute=False, report_progress=False,
-                      data_dir='data/', **tfidf_params):
+                      data_dir='data/', workers=1, chunksize=2000, **tfidf_params):
 
     """Use topic modeling to create a dense matrix representation of the input text.
 
@@ -52,6 +93,10 @@ def gensim_preprocess(train, test, model_type='lsi', num_topics=500,
     The concatenation is used to create the models, i.e compute embeddings since the labels are not needed in this unsupervised stage.
     The first two are used for the training and evaluation/submission stages accordingly.
 
+    The dictionary and the train/test corpora are persisted in `data_dir`/gensim and streamed from disk, the
+    concatenation is a lazy chain of the two. Once they exist, the raw text is not used unless `force_compute` is set.
+    The tokens are kept in the token store shared with the other preprocessing functions, see `token_store_dir`.
+
     Parameters
     ----------
     :param train: The training set as a pd.Dataframe including the free text column "comment_text".
@@ -64,13 +109,18 @@ def gensim_preprocess(train, test, model_type='lsi', num_topics=500,
     :report_progress: If True, progress will be reported when each computationally expensive step is starting.
     :data_dir: Path to the base data directory. Used to call this method from anywhere.
                For example a notebook would provide `data_dir='../data'`
+    :workers: Number of worker processes used to train the LDA model. If larger than 1 (or None for all cores but one)
+              gensim's `LdaMulticore` is used. Ignored for LSI.
+    :chunksize: Number of documents in each training chunk of the LDA model.
     :**tfidf_params: Key-Value parameters passed to our own `tf_idf` implementation.
                      Only used if `use_own_tfidf` is set to True.
 
     Returns
     -------
-    :return: (train, test) datasets as 2D np.ndarrays of shape (num_comments, `num_topics`)
+    :return: (train, test) datasets as 2D float32 np.ndarrays of shape (num_comments, `num_topics`)
     """
+    # Imported here since gensim is slow to import and only needed by this function
+    from gensim import corpora, models
 
     # Folder where gensim models and data will be saved to and loaded from.
     gensim_dir = data_dir + 'gensim/'
@@ -83,55 +133,52 @@ def gensim_preprocess(train, test, model_type='lsi', num_topics=500,
     if force_compute:
         progress("This is gonna take a while mate, grab a coffee/beer. Actually you might wanna take a walk as well. Or a nap :D")
 
-    train_text = train["comment_text"].tolist()
-    test_text = test["comment_text"].tolist()
-
-    # Tokenize
-    def safe_tokenize(comment):
-        """Wrap `nltk.word_tokenize` but also handle corrupted input."""
-        try:
-            return nltk.word_tokenize(comment)
-        except TypeError:
-            return ["UNKNOWN"]
-
-    progress("Tokenizing text, this will take a while...")
-    train_texts = [safe_tokenize(comment) for comment in train_text]
-    test_texts = [safe_tokenize(comment) for comment in test_text]
+    dictionary_path = gensim_dir + 'dictionary.dict'
+    train_corpus_path = gensim_dir + 'training_corpus.mm'
+    test_corpus_path = gensim_dir + 'test_corpus.mm'
+
+    # Read or create the dictionary and the corpora. Once they are on disk, the raw text is not even looked at.
+    if force_compute or not all(os.path.exists(path) for path in (dictionary_path, train_corpus_path, test_corpus_path)):
+        n_train = train.shape[0]
+        all_text = train["comment_text"].tolist() + test["comment_text"].tolist()
+
+        # Tokenize, corrupted input is mapped to ["UNKNOWN"]. Duplicate comments are only processed once.
+        progress("Tokenizing text, this will take a while...")
+        index = DedupIndex(all_text)
+        unique_texts = load_or_tokenize(index.unique.tolist(), Tokenizer(stemming=False, cache_size=0), lowercase=False,
+                                        store_dir=token_store_dir(data_dir))
+
+        progress("Creating the gensim dictionary and corpora, this will take a while...")
+        # Document frequencies count every comment, duplicates included
+        dictionary = corpora.Dictionary(index.scatter(unique_texts))
+        dictionary.save(dictionary_path)
+        bows = [dictionary.doc2bow(comment) for comment in unique_texts]
+        corpora.MmCorpus.serialize(train_corpus_path, (bows[code] for code in index.codes[:n_train]))
+        corpora.MmCorpus.serialize(test_corpus_path, (bows[code] for code in index.codes[n_train:]))
+        del all_text, unique_texts, bows
+    else:
+        dictionary = corpora.Dictionary.load(dictionary_path)
 
-    dictionary = corpora.Dictionary(train_texts + test_texts)
+    # The corpora are streamed from disk instead of being held in memory
+    train_corpus = corpora.MmCorpus(train_corpus_path)
+    test_corpus = corpora.MmCorpus(test_corpus_path)
+    whole_corpus = ChainedCorpus(train_corpus, test_corpus)
 
     # Lets create the TF-IDF representation needed for the dimensionality reduction models.
     if use_own_tfidf:
         # Untested yet but I hope it works. I mean, why wouldn't it right?
         progress("Using our own version of TF-IDF, this will take a while...")
+        tfidf_params.setdefault('store_dir', token_store_dir(data_dir))
         train_tfidf, test_tfidf, whole_tfidf = tf_idf(train, test, **tfidf_params)
 
     else:
         # Use gensims TFIDF model - Tested while under the influence of 10 beers.
         # I code well when drunk though so no worries.
-
-        # Read or create the corpus
-        try:
-            # Hack to redirect to the exception handler - yes I know its bad but I like it mmmkay?
-            if force_compute:
-                raise FileNotFoundError
-            train_corpus = corpora.MmCorpus(gensim_dir + 'training_corpus.mm')
-            test_corpus = corpora.MmCorpus(gensim_dir + 'test_corpus.mm')
-            whole_corpus = corpora.MmCorpus(gensim_dir + 'whole_corpus')
-        except FileNotFoundError:
-            progress("Creating the gensim corpora, this will take a while...")
-            train_corpus = [dictionary.doc2bow(comment) for comment in train_texts]
-            test_corpus = [dictionary.doc2bow(comment) for comment in test_texts]
-            whole_corpus = [dictionary.doc2bow(comment) for comment in train_texts + test_texts]
-            corpora.MmCorpus.serialize(gensim_dir + 'training_corpus.mm', train_corpus)
-            corpora.MmCorpus.serialize(gensim_dir + 'test_corpus.mm', test_corpus)
-            corpora.MmCorpus.serialize(gensim_dir + 'whole_corpus.mm', whole_corpus)
-
         progress("Using gensim's implementation of TF-IDF, this will take a while...")
         tfidf_model = models.TfidfModel(whole_corpus)
         train_tfidf = tfidf_model[train_corpus]
         test_tfidf = tfidf_model[test_corpus]
-        whole_tfidf = tfidf_model[train_corpus + test_corpus]
+        whole_tfidf = tfidf_model[whole_corpus]
 
     # Feed the TF-IDF representation to the dimensionality reduction model - this is slow so try to load it first.
     if model_type == 'lsi':
@@ -150,30 +197,103 @@ def gensim_preprocess(train, test, model_type='lsi', num_topics=500,
             # Hack to redirect to the exception handler - yes I know its bad but I like it mmmkay?
             if force_compute:
                 raise FileNotFoundError
-            model = models.LdaModel.load('data/lda.model')
+            model = models.LdaModel.load(gensim_dir + 'lda.model')
         except FileNotFoundError:
             progress("Creating the LDA model, this will take a while...")
-            model = models.LdaModel(whole_tfidf, id2word=dictionary, num_topics=num_topics)
+            if workers == 1:
+                model = models.LdaModel(whole_tfidf, id2word=dictionary, num_topics=num_topics, chunksize=chunksize)
+            else:
+                model = models.LdaMulticore(whole_tfidf, id2word=dictionary, num_topics=num_topics, chunksize=chunksize,
+                                            workers=workers)
             model.save(gensim_dir + 'lda.model')
 
     else:
         raise ValueError("Only 'lda' and 'lsi' models are supported, you passed {}".format(model_type))
 
-    train = model[train_tfidf]
-    test = model[test_tfidf]
-
     # Transform into a 2D array format.
-    print("Reformatting output to a 2D array, this will take a while...")
-    values = np.vectorize(lambda x: x[1])
-    return values(np.array(train)), values(np.array(test))
+    progress("Reformatting output to a 2D array...")
+    return topics_to_dense(model[train_tfidf], num_topics), topics_to_dense(model[test_tfidf], num_topics)
+
+
+def streaming_svd(x, n_components, n_iter=7, batch_size=10000, n_oversamples=10, random_state=None):
+    """
+    Randomized truncated SVD which only ever multiplies row blocks of the input, so the matrix can be memory-mapped
+    and is never copied or densified as a whole. Like `TruncatedSVD` the input is not centered.
+
+    Every power iteration is a pass over the row blocks accumulating X^T (X Q). The right singular vectors are
+    then recovered from the small Gram matrix of X Q, accumulated in a last pass.
+
+    :param x: Sparse matrix of shape (n_samples, n_features)
+    :param n_components: Number of singular vectors to compute
+    :param n_iter: Number of power iterations (passes over the data)
+    :param batch_size: Number of rows multiplied at once
+    :param n_oversamples: Number of extra random vectors, which improve the accuracy of the leading components
+    :param random_state: Seed of the random projection
+    :return: np.ndarray of shape (n_components, n_features) holding the components, as `TruncatedSVD.components_`
+    """
+    def blocks():
+        for start in range(0, x.shape[0], batch_size):
+            yield x[start:start + batch_size]
+
+    rng = np.random.RandomState(random_state)
+    q, _ = np.linalg.qr(rng.normal(size=(x.shape[1], n_components + n_oversamples)))
+    for _ in range(n_iter):
+        z = np.zeros_like(q)
+        for block in blocks():
+            z += block.T.dot(block.dot(q))
+        q, _ = np.linalg.qr(z)
+
+    gram = np.zeros((q.shape[1], q.shape[1]))
+    for block in blocks():
+        projected = block.dot(q)
+        gram += projected.T.dot(projected)
+
+    # Eigenvalues of the Gram matrix are the squared singular values, sort them in decreasing order
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return q.dot(eigenvectors[:, order]).T
+
+
+def _svd_components_prefix(x, n_iter, method):
+    return 'components_{}_{}_{}_'.format(fingerprint(x), n_iter, method)
+
+
+def load_svd_components(svd_dir, x, n_components, n_iter, method):
+    """
+    Looks for cached SVD components of the matrix `x` fitted with the same settings and at least `n_components`
+    components. Components are sorted by decreasing singular value, so a larger decomposition is truncated.
+
+    :return: np.ndarray of shape (n_components, n_features) or None if nothing suitable is cached
+    """
+    if not os.path.exists(svd_dir):
+        return None
+    prefix = _svd_components_prefix(x, n_iter, method)
+    sizes = [int(f[len(prefix):-len('.npy')]) for f in os.listdir(svd_dir) if f.startswith(prefix) and f.endswith('.npy')]
+    sizes = [size for size in sizes if size >= n_components]
+    if not sizes:
+        return None
+
+    path = os.path.join(svd_dir, '{}{}.npy'.format(prefix, min(sizes)))
+    print("Reusing the SVD components cached at {}".format(path))
+    return np.load(path, mmap_mode='r')[:n_components]
+
+
+def save_svd_components(svd_dir, x, components, n_iter, method):
+    """Caches the SVD components fitted on the matrix `x`, see `load_svd_components`."""
+    if not os.path.exists(svd_dir):
+        os.makedirs(svd_dir)
+    np.save(os.path.join(svd_dir, '{}{}.npy'.format(_svd_components_prefix(x, n_iter, method), components.shape[0])),
+            components)
 
 
 @check_compatibility
 @timing
 def truncatedsvd_preprocess(train, test, num_topics=500, report_progress=False,
-                            use_own_tfidf=True, data_dir='data/', save=False, **tfidf_params):
+                            use_own_tfidf=True, data_dir='data/', save=False, n_iter=7, batch_size=None,
+                            use_cache=True, compact=False, **tfidf_params):
 
     """ Use Latent Semantic Analysis (LSA/LSI) to obtain a dense matrix representation of the input text.
+    The tokens are kept in the token store shared with the other preprocessing functions, see `token_store_dir`.
 
     Parameters
     ----------
@@ -184,6 +304,15 @@ def truncatedsvd_preprocess(train, test, num_topics=500, report_progress=False,
     :use_own_tfidf: If True, uses our own implementation of tfidf.
     :data_dir: Path to the base data directory. Used to call this method from anywhere.
                For example a notebook would provide `data_dir='../data'`
+    :save: If True, the outputs are saved in `data_dir` as `train_<num_topics>` and `test_<num_topics>`, which can be
+           read back with `utils.load_dense_frame`.
+    :n_iter: Number of power iterations of the randomized SVD.
+    :batch_size: If provided, the decomposition streams row blocks of `batch_size` rows of the TF-IDF matrix
+                 (see `streaming_svd`) instead of using sklearn's `TruncatedSVD` on the whole matrix.
+    :compact: If True, the TF-IDF matrices and the outputs are float32 instead of float64.
+    :use_cache: If True, the fitted components are cached in `data_dir`/svd keyed by the TF-IDF matrix, `n_iter` and
+                the method. A cached decomposition with at least `num_topics` components is reused by truncating it,
+                so sweeping `num_topics` downwards does not refit anything.
 
     Returns
     -------
@@ -195,56 +324,69 @@ def truncatedsvd_preprocess(train, test, num_topics=500, report_progress=False,
         if report_progress:
             print(msg)
 
-    # create lists of comments/strings
-    train_text = train["comment_text"].tolist()
-    test_text = test["comment_text"].tolist()
-    all_text = train_text + test_text
+    n_train = train.shape[0]
 
     # create the TF-IDF representation needed for dimensionality reduction.
     if use_own_tfidf:
         # Untested yet but I hope it works. I mean, why wouldn't it right?
         progress("Using our own version of TF-IDF, this will take a while...")
-        train_tfidf, test_tfidf, whole_tfidf = tf_idf(train, test, **tfidf_params)
+        tfidf_params.setdefault('store_dir', token_store_dir(data_dir))
+        train_tfidf, test_tfidf, whole_tfidf = tf_idf(train, test, compact=compact, **tfidf_params)
 
     else:
         # use sklearn's TF-IDF in combination with NLTK's tokenizer
         progress("Creating TF-IDF model and representations..")
-        tfidf_model = TfidfVectorizer(input='content',
-                                      encoding='utf-8',
-                                      decode_error='strict',
-                                      lowercase=True,
-                                      tokenizer=nltk.word_tokenize,
-                                      analyzer='word',
-                                      stop_words=None)
-
-        tfidf_model.fit(all_text)
-        train_tfidf = tfidf_model.transform(train_text)
-        test_tfidf = tfidf_model.transform(test_text)
-        whole_tfidf = tfidf_model.transform(all_text)
+        tokenizer, lowercase, strip_accents, params = pretokenized_params({'input': 'content',
+                                                                           'encoding': 'utf-8',
+                                                                           'decode_error': 'strict',
+                                                                           'lowercase': True,
+                                                                           'tokenizer': Tokenizer(stemming=False, cache_size=0),
+                                                                           'analyzer': 'word',
+                                                                           'stop_words': None,
+                                                                           'dtype': np.float32 if compact else np.float64})
+        all_text = train["comment_text"].tolist() + test["comment_text"].tolist()
+        all_texts = load_or_tokenize(all_text, tokenizer, lowercase, strip_accents, store_dir=token_store_dir(data_dir))
+        tfidf_model = TfidfVectorizer(**params)
+
+        whole_tfidf = tfidf_model.fit_transform(all_texts)
+        train_tfidf = whole_tfidf[:n_train]
+        test_tfidf = whole_tfidf[n_train:]
 
     # Feed the TF-IDF representation to the dimensionality reduction model.
-    progress("Fitting SVD to all data..")
-    svd = TruncatedSVD(n_components=num_topics, n_iter=7)
-    svd.fit(whole_tfidf)
+    method = 'truncated' if batch_size is None else 'streaming'
+    svd_dir = data_dir + 'svd/'
+    components = load_svd_components(svd_dir, whole_tfidf, num_topics, n_iter, method) if use_cache else None
+    if components is None:
+        progress("Fitting SVD to all data..")
+        if batch_size is None:
+            components = TruncatedSVD(n_components=num_topics, n_iter=n_iter).fit(whole_tfidf).components_
+        else:
+            components = streaming_svd(whole_tfidf, num_topics, n_iter=n_iter, batch_size=batch_size)
+        if use_cache:
+            save_svd_components(svd_dir, whole_tfidf, components, n_iter, method)
+
+    if compact:
+        components = components.astype(np.float32)
 
     progress("Transforming train and test sets..")
-    x_train = svd.transform(train_tfidf)
-    x_test = svd.transform(test_tfidf)
+    x_train = train_tfidf.dot(components.T)
+    x_test = test_tfidf.dot(components.T)
 
     # save and return data
     x_train = pd.DataFrame(x_train)
     x_test = pd.DataFrame(x_test)
 
     if save:
-        x_train.to_csv(data_dir+"train_"+str(int(num_topics))+".csv")
-        x_test.to_csv(data_dir+"test_"+str(int(num_topics))+".csv")
+        save_dense_frame(data_dir+"train_"+str(int(num_topics)), x_train)
+        save_dense_frame(data_dir+"test_"+str(int(num_topics)), x_test)
 
     progress("Dimensionality reduction completed.")
     return x_train, x_test
 
 
 @timing
-def tf_idf(train, test, params=None, remove_numbers_function=True, debug=False, stemming=True, lemmatization=False):
+def tf_idf(train, test, params=None, remove_numbers_function=True, debug=False, stemming=True, lemmatization=False,
+           n_jobs=None, chunksize=10000, cache_dir=None, store_dir=None, compact=False):
     """
     Performs preprocessing of the data set and tokenization
     Each input is numpy array:
@@ -252,72 +394,41 @@ def tf_idf(train, test, params=None, remove_numbers_function=True, debug=False,
     test: test to test the model
     params: None by default. It is use to define parameters of the tf_idf model
     remove_numbers_function: True if removing numbers is desired
+    n_jobs: Number of processes used for tokenization. Defaults to all cores but one. The output does not depend on it.
+    chunksize: Number of comments sent to a tokenizing process at once
+    cache_dir: If provided, the stems/lemmas memoized by the tokenizer are loaded from and saved to this directory
+    store_dir: If provided, the tokenized corpus is persisted in this directory and reused by subsequent calls
+    compact: If True, the matrices are float32 instead of float64, unless `params` specify a dtype. This halves their
+             memory without hurting the AUC of the predictors.
+
+    The corpus is tokenized and vectorized once, train and test are row slices of the whole matrix.
 
     Returns:
     train: train set in sparce marix form
     test: test set in sparce matrix form
+    whole: train and test sets stacked in sparse matrix form
     """
-    train["comment_text"].fillna("unknown", inplace=True)
-    test["comment_text"].fillna("unknown", inplace=True)
+    # The text is normalized on copies, the frames of the caller are left as they are so that the cache keys computed
+    # from them, e.g. by `get_sparse_matrix`, stay the same across calls
+    train_text = train["comment_text"].fillna("unknown")
+    test_text = test["comment_text"].fillna("unknown")
 
     if remove_numbers_function:
-        train, test = remove_numbers(train, test)
+        train_text = remove_numbers_helper(train_text)
+        test_text = remove_numbers_helper(test_text)
 
     if lemmatization + stemming == 2:
         raise ValueError("It is not possible to apply both stemming and lemmatization. Please choose one of them.")
-    if stemming:
-        def tokenizer(s):
-            stemmer = nltk.stem.PorterStemmer()
-            tokens = nltk.word_tokenize(s)
-            stems = []
-            for item in tokens:
-                try:
-                    stems.append(stemmer.stem(item))
-                except RecursionError:
-                    stems.append('Big_word')
-            return stems
-    elif lemmatization:
-        def tokenizer(s):
-            lemmatizer = nltk.stem.WordNetLemmatizer()
-            lem = []
-            for item, tag in nltk.pos_tag(nltk.word_tokenize(s)):
-                if tag.startswith("NN"):
-                    try:
-                        lem.append(lemmatizer.lemmatize(item, pos='n'))
-                    except RecursionError:
-                        lem.append('Big_word')
-                elif tag.startswith('VB'):
-                    try:
-                        lem.append(lemmatizer.lemmatize(item, pos='v'))
-                    except RecursionError:
-                        lem.append('Big_word')
-                elif tag.startswith('JJ'):
-                    try:
-                        lem.append(lemmatizer.lemmatize(item, pos='a'))
-                    except RecursionError:
-                        lem.append('Big_word')
-                elif tag.startswith('R'):
-                    try:
-                        lem.append(lemmatizer.lemmatize(item, pos='r'))
-                    except RecursionError:
-                        lem.append('Big_word')
-                else:
-                    try:
-                        lem.append(lemmatizer.lemmatize(item))
-                    except RecursionError:
-                        lem.append('Big_word')
-            return lem
-    else:
-        def tokenizer(s):
-            try:
-                return nltk.word_tokenize(s)
-            except TypeError:
-                return ["UNKNOWN"]
 
     if not params:
+        cache_path = None
+        if cache_dir and (stemming or lemmatization):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            cache_path = os.path.join(cache_dir, 'stems.pkl' if stemming else 'lemmas.pkl')
         params = {
             "ngram_range": (1, 2),
-            "tokenizer": tokenizer,
+            "tokenizer": Tokenizer(stemming=stemming, lemmatization=lemmatization, cache_path=cache_path),
             "min_df": 0.0001,
             "max_df": 0.995,
             "strip_accents": 'unicode',
@@ -325,12 +436,26 @@ def tf_idf(train, test, params=None, remove_numbers_function=True, debug=False,
             "smooth_idf": 1,
             "sublinear_tf": 1
         }
+
+    n_train = train.shape[0]
+    all_text = train_text.tolist() + test_text.tolist()
+
+    if callable(params.get("tokenizer")) and params.get("analyzer", "word") == "word":
+        # Tokenize in parallel (or load the tokens from the store) and let the vectorizer work on the tokens
+        tokenizer, lowercase, strip_accents, params = pretokenized_params(params)
+        all_text = load_or_tokenize(all_text, tokenizer, lowercase, strip_accents, n_jobs, chunksize, store_dir)
+        if isinstance(tokenizer, Tokenizer) and tokenizer.cache is not None:
+            print("Tokenizer cache: {}".format(tokenizer.cache))
+            tokenizer.save_cache()
+
+    if compact:
+        params = dict(params)
+        params.setdefault("dtype", np.float32)
     vec = TfidfVectorizer(**params)
 
-    all_text = train["comment_text"].tolist() + test["comment_text"].tolist()
     whole = vec.fit_transform(all_text)
-    train = vec.transform(train["comment_text"])
-    test = vec.transform(test["comment_text"])
+    train = whole[:n_train]
+    test = whole[n_train:]
 
     if debug:
         print("Removing these tokens:\n{}".format(vec.stop_words_))
@@ -338,18 +463,192 @@ def tf_idf(train, test, params=None, remove_numbers_function=True, debug=False,
     return train, test, whole
 
 
+def _read_comments(filename, chunksize, remove_numbers_function):
+    """Generator over the comments of a csv file, `chunksize` comments at a time, prepared as in `tf_idf`."""
+    for chunk in pd.read_csv(filename, usecols=["comment_text"], chunksize=chunksize):
+        comments = chunk["comment_text"].fillna("unknown")
+        if remove_numbers_function:
+            comments = remove_numbers_helper(comments)
+        yield comments.tolist()
+
+
+def _idf(df, n_docs, smooth_idf=True, min_df=1, max_df=1.0):
+    """
+    Computes the inverse document frequencies the way `TfidfVectorizer` does.
+    Features whose document frequency is out of [min_df, max_df] get an idf of 0, i.e. they are pruned.
+
+    :param df: Array holding the number of documents each feature occurs in
+    :param n_docs: Number of documents
+    :param min_df, max_df: Proportion of documents (float) or absolute number of documents (int), as in `TfidfVectorizer`
+    :return: Array of idf weights
+    """
+    min_count = min_df * n_docs if isinstance(min_df, float) else min_df
+    max_count = max_df * n_docs if isinstance(max_df, float) else max_df
+    idf = np.log((n_docs + smooth_idf) / (df + smooth_idf)) + 1
+    idf[(df < min_count) | (df > max_count) | (df == 0)] = 0
+    return idf
+
+
+def _weight(counts, idf, sublinear_tf=True):
+    """Turns a sparse matrix of term counts into L2 normalized tf-idf weights."""
+    counts = counts.tocsr().astype(idf.dtype)
+    if sublinear_tf:
+        counts.data = np.log(counts.data) + 1
+    weighted = counts.multiply(idf).tocsr()
+    weighted.eliminate_zeros()
+    return normalize(weighted, norm='l2', copy=False)
+
+
+@timing
+def streaming_tf_idf(train_file, test_file, chunksize=50000, n_features=2 ** 22, ngram_range=(1, 2), min_df=0.0001,
+                     max_df=0.995, sublinear_tf=True, smooth_idf=True, remove_numbers_function=True, stemming=True,
+                     lemmatization=False, n_jobs=None):
+    """
+    Out-of-core version of `tf_idf` for corpora which do not fit in memory.
+
+    The csv files are read in chunks of `chunksize` comments and their uni/bigrams are hashed into a fixed number of
+    features instead of building a vocabulary. A first pass accumulates the document frequencies, a second pass emits
+    the tf-idf weights. Apart from the output, memory is bounded by the chunk size rather than the corpus size.
+    Since the features are hashed, the columns are not the same as the ones of `tf_idf`.
+
+    Parameters
+    -------------------------
+    train_file, test_file: Paths of the csv files including the free text column "comment_text"
+    chunksize: Number of comments read and vectorized at once
+    n_features: Number of columns of the output matrices. Larger values mean less hash collisions.
+    ngram_range, min_df, max_df, sublinear_tf, smooth_idf: See `TfidfVectorizer`
+    remove_numbers_function, stemming, lemmatization, n_jobs: See `tf_idf`
+
+    Returns:
+    --------------------------
+    train: train set in sparse matrix form
+    test: test set in sparse matrix form
+    """
+    tokenizer, lowercase, strip_accents, params = pretokenized_params({
+        "ngram_range": ngram_range,
+        "tokenizer": Tokenizer(stemming=stemming, lemmatization=lemmatization),
+        "strip_accents": 'unicode',
+        "n_features": n_features,
+        "alternate_sign": False,
+        "norm": None
+    })
+    vec = HashingVectorizer(**params)
+    n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+
+    def hashed_chunks(filename):
+        for comments in _read_comments(filename, chunksize, remove_numbers_function):
+            # Every chunk read is split among the processes, it holds at most `chunksize` comments
+            tokens = tokenize_corpus(comments, tokenizer, lowercase, strip_accents, n_jobs, -(-len(comments) // n_jobs))
+            yield vec.transform(tokens)
+
+    # First pass: document frequencies of the hashed features
+    df = np.zeros(n_features)
+    n_docs = 0
+    for filename in (train_file, test_file):
+        for counts in hashed_chunks(filename):
+            df += np.bincount(counts.indices, minlength=n_features)
+            n_docs += counts.shape[0]
+    idf = _idf(df, n_docs, smooth_idf, min_df, max_df)
+    del df
+
+    # Second pass: tf-idf weights
+    train = vstack([_weight(counts, idf, sublinear_tf) for counts in hashed_chunks(train_file)], format='csr')
+    test = vstack([_weight(counts, idf, sublinear_tf) for counts in hashed_chunks(test_file)], format='csr')
+    return train, test
+
+
+def char_tf_idf(train, test, params=None, remove_numbers_function=True, n_jobs=None, chunksize=10000, compact=False):
+    """
+    Character n-gram version of `tf_idf`, the strongest signal against obfuscated words like "f*ck".
+
+    A vocabulary of character n-grams would not fit in memory, so the n-grams are hashed into a fixed number of
+    features (see `HashingVectorizer`) and weighted like `tf_idf` does. The comments are hashed in chunks of `chunksize`
+    comments by a pool of processes.
+
+    Parameters
+    -------------------------
+    train, test: pd.DataFrames including the free text column "comment_text"
+    params: None by default. Parameters of the `HashingVectorizer` (e.g. `n_features`, `ngram_range` or
+            `analyzer='char_wb'`) along with `min_df`, `max_df`, `sublinear_tf` and `smooth_idf` as in `TfidfVectorizer`
+    remove_numbers_function: True if removing numbers is desired
+    n_jobs: Number of processes used for hashing. Defaults to all cores but one. The output does not depend on it.
+    chunksize: Number of comments hashed at once
+    compact: If True, the matrices are float32 instead of float64
+
+    Returns:
+    --------------------------
+    train: train set in sparse matrix form
+    test: test set in sparse matrix form
+    whole: train and test sets stacked in sparse matrix form
+    """
+    params = dict({
+        "analyzer": 'char',
+        "ngram_range": (2, 5),
+        "n_features": 2 ** 20,
+        "strip_accents": 'unicode',
+        "min_df": 0.0001,
+        "max_df": 1.0,
+        "sublinear_tf": True,
+        "smooth_idf": True
+    }, **(params or {}))
+    idf_params = {name: params.pop(name) for name in ("min_df", "max_df", "sublinear_tf", "smooth_idf")}
+    vec = HashingVectorizer(alternate_sign=False, norm=None, dtype=np.float32 if compact else np.float64, **params)
+
+    comments = pd.concat([train["comment_text"], test["comment_text"]]).fillna("unknown")
+    if remove_numbers_function:
+        comments = remove_numbers_helper(comments)
+    comments = comments.tolist()
+    chunks = [comments[i:i + chunksize] for i in range(0, len(comments), chunksize)]
+
+    n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+    if n_jobs == 1 or len(chunks) == 1:
+        counts = [vec.transform(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(processes=min(n_jobs, len(chunks)))
+        try:
+            counts = pool.map(vec.transform, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    df = np.zeros(params["n_features"])
+    for chunk in counts:
+        df += np.bincount(chunk.indices, minlength=params["n_features"])
+    idf = _idf(df, len(comments), idf_params["smooth_idf"], idf_params["min_df"], idf_params["max_df"])
+    idf = idf.astype(vec.dtype)
+
+    # Weight the chunks one by one so that the counts of a single chunk are held next to the weights
+    for i, chunk in enumerate(counts):
+        counts[i] = _weight(chunk, idf, idf_params["sublinear_tf"])
+    whole = vstack(counts, format='csr')
+    return whole[:train.shape[0]], whole[train.shape[0]:], whole
+
+
 def get_sparse_matrix(train=None, test=None, params=None, remove_numbers_function=True, debug=True, save=False,
-                      load=True, data_dir="data", stemming=True, lemmatization=False):
+                      load=True, data_dir="data", stemming=True, lemmatization=False, n_jobs=None,
+                      cache_size=CACHE_SIZE_DEFAULT, mmap_mode=None, compact=False, analyzer='word'):
     """
     Get sparse matrix form of the train and test set
 
+    The matrices are cached under `data_dir`/output/cache keyed by a hash of the input text and of all the parameters,
+    so different preprocessing variants are kept side by side and a variant computed before is simply loaded.
+
     Parameters
     -------------------------
     Each input is numpy array:
     train, test, params: See the documentation of tf_idf function
-    save: To save the train and test sprse matrices on . npz format
-    load: To load the train and test sprse matrices from your local machine
+    save: To save the train and test sprse matrices in the cache
+    load: To load the train and test sprse matrices from the cache if they have been computed before.
+          If train and test are not provided, the variant saved last is loaded.
     data_dir: Specify the ro specifi the data directory where the matrices are saved
+    n_jobs: Number of processes used for tokenization, see `tf_idf`
+    cache_size: Maximum size of the cache on disk in bytes, least recently used variants are evicted beyond it
+    mmap_mode: Set to 'r' to memory-map the matrices loaded from the cache instead of reading them, see `load_sparse_csr`
+    compact: If True, the matrices are float32 instead of float64, see `tf_idf`
+    analyzer: 'word' for the word n-grams of `tf_idf`, 'char' for the hashed character n-grams of `char_tf_idf`.
+              `params` are then the ones of `char_tf_idf`
+    The stems/lemmas memoized by the tokenizer are persisted under `data_dir`/output/tokenizer and the tokens under
+    `data_dir`/output/tokens
 
     Returns:
     --------------------------
@@ -362,33 +661,45 @@ def get_sparse_matrix(train=None, test=None, params=None, remove_numbers_functio
         >>> test = pd.read_csv("data/test.csv")
         >>> # to create and save the train and test set
         >>> train_sparse, test_sparse = get_sparse_matrix(train, test, params=None, remove_numbers_function=True, debug=True, save=True, load=False)
-        >>> # to load the sparse matrices from your local machine
+        >>> # to load the sparse matrices of this variant from your local machine, computing them if needed
+        >>> train_sparse, test_sparse = get_sparse_matrix(train, test, params=None, remove_numbers_function=True)
+        >>> # to load the sparse matrices saved last from your local machine
         >>> train, test = get_sparse_matrix(load=True)
 
     """
     base_dir = data_dir + '/output/'
-
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
-
-    name_train = base_dir + 'sparce_train.npz'
-    name_test = base_dir + 'sparce_test.npz'
-
-    if load:
-        if os.path.exists(name_train) and os.path.exists(name_test):
-            train, test = load_sparse_csr(name_train), load_sparse_csr(name_test)
-        else:
-            raise ValueError("You asked to load the features but they were not found"
-                             + "at the specified location: \n{}\n{}".format(name_train, name_test))
+    cache = ArtifactCache(base_dir + 'cache', max_size=cache_size)
+
+    if train is None or test is None:
+        if not load:
+            raise ValueError("Please provide the train and test sets to compute the sparse matrices from")
+        entry = cache.latest('sparse_matrix')
+        if entry is None:
+            raise ValueError("You asked to load the features but none were found at the specified location: {}"
+                             .format(cache.cache_dir))
+        return load_sparse_csr(os.path.join(entry, 'train'), mmap_mode), load_sparse_csr(os.path.join(entry, 'test'), mmap_mode)
+
+    key = cache.key(train["comment_text"], test["comment_text"], params=params,
+                    remove_numbers_function=remove_numbers_function, stemming=stemming, lemmatization=lemmatization,
+                    compact=compact, analyzer=analyzer)
+    entry = cache.get(key) if load else None
+    if entry is not None:
+        return load_sparse_csr(os.path.join(entry, 'train'), mmap_mode), load_sparse_csr(os.path.join(entry, 'test'), mmap_mode)
+
+    print('Computing the sparse matrixes, this will take a while...!')
+    if analyzer == 'char':
+        train, test, _ = char_tf_idf(train, test, params, remove_numbers_function, n_jobs, compact=compact)
+    elif analyzer == 'word':
+        train, test, _ = tf_idf(train, test, params, remove_numbers_function, debug, stemming, lemmatization, n_jobs,
+                                cache_dir=base_dir + 'tokenizer', store_dir=token_store_dir(data_dir), compact=compact)
     else:
-        print('Computing the sparse matrixes, this will take a while...!')
-        train, test, _ = tf_idf(train, test, params, remove_numbers_function, debug, stemming, lemmatization)
+        raise ValueError("The analyzer must be either 'word' or 'char', not {}".format(analyzer))
 
     if save:
-        print('Saving train file as {}'.format(name_train))
-        save_sparse_csr(name_train, train)
-        print('Saving test file as {}'.format(name_test))
-        save_sparse_csr(name_test, test)
+        with cache.put(key, name='sparse_matrix') as entry:
+            print('Saving train and test files in {}'.format(entry))
+            save_sparse_csr(os.path.join(entry, 'train'), train)
+            save_sparse_csr(os.path.join(entry, 'test'), test)
 
     return train, test
 
@@ -0,0 +1,39 @@
+import unittest
+import pathmagic  # noqa
+from feature_adder import BadWordMatcher
+
+
+class TestBadWordMatcher(unittest.TestCase):
+    badwords = ['idiot', 'son of a', 'Idiot', 'stupid  idiot', 'you suck', 'shut up ']
+
+    comments = ['you are an idiot !',
+                'idiot at the start',
+                'at the end an idiot',
+                'idiot',
+                ' idiot ',
+                'a stupid  idiot indeed',
+                'a stupid idiot indeed',
+                'such a SON OF A gun',
+                'you suck at this',
+                'well you suck ',
+                'just shut up  now',
+                'just shut up now',
+                'idiots and idiot.',
+                '',
+                float('nan')]
+
+    @staticmethod
+    def substring_count(badwords, comment):
+        """The definition the matcher follows: a bad word counts when it appears surrounded by spaces"""
+        if not isinstance(comment, str):
+            return 0
+        return sum(' {} '.format(w).lower() in comment.lower() for w in badwords)
+
+    def test_count(self):
+        matcher = BadWordMatcher(self.badwords)
+        for comment in self.comments:
+            self.assertEqual(matcher.count(comment), self.substring_count(self.badwords, comment), repr(comment))
+
+
+if __name__ == '__main__':
+    unittest.main()
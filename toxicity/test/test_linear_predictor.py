@@ -2,9 +2,11 @@ import numbers
 import unittest
 import pathmagic  # noqa
 from linear_predictor import LogisticPredictor
+from predictor import RANDOM_STATE
 import utils
 import pandas as pd
 from preprocessing import tf_idf
+from cache import FoldCache
 
 train_file = "../data/train.csv"
 test_file = "../data/test.csv"
@@ -35,6 +37,21 @@ class TestLinearPredictor(unittest.TestCase):
         loss = self.logistic_predictor.evaluate(self.train, self.y_train, method='split')
         assert isinstance(loss, numbers.Number)
 
+    def test_fold_cache(self):
+        """The materialized folds give the same score as slicing the features"""
+        # liblinear's dual solver draws a seed on every fit unless it is fixed
+        predictor = LogisticPredictor(random_state=RANDOM_STATE, **TestLinearPredictor.lr_params)
+        loss = predictor.evaluate(self.train, self.y_train, method='CV')
+        cached = predictor.evaluate(self.train, self.y_train, method='CV', fold_cache=FoldCache(materialize=True))
+        assert loss == cached
+
+    def test_path(self):
+        """Every score of the regularization path is the one of `evaluate`, since liblinear does not warm start"""
+        predictor = LogisticPredictor(random_state=RANDOM_STATE, **TestLinearPredictor.lr_params)
+        path = predictor.evaluate_path(self.train, self.y_train, 'C', [4, 1], method='split')
+        assert [C for C, _ in path] == [1, 4]
+        assert abs(path[1][1] - predictor.evaluate(self.train, self.y_train, method='split')) < 1e-9
+
     def test_predict_proba(self):
         """We will test for the 'toxic' tag"""
         self.logistic_predictor.fit(self.train, self.y_train['toxic'])
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+import pathmagic  # noqa
+import numpy as np
+import pandas as pd
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+import utils
+from linear_predictor import LogisticPredictor
+from preprocessing import tf_idf, streaming_tf_idf, remove_numbers_helper
+from tokenizer import Tokenizer
+
+train_file = "../data/train.csv"
+test_file = "../data/test.csv"
+
+
+class TestPreprocessing(unittest.TestCase):
+    # We will use a chunk of the dataset of n rows
+    number_of_rows = 1000
+
+    def setUp(self):
+        self.train = pd.read_csv(train_file, nrows=TestPreprocessing.number_of_rows)
+        self.test = pd.read_csv(test_file, nrows=TestPreprocessing.number_of_rows)
+
+    def assert_same_matrices(self, first, second):
+        for a, b in zip(first, second):
+            assert a.shape == b.shape
+            assert (a != b).nnz == 0
+
+    def test_parallel_tokenization(self):
+        serial = tf_idf(self.train.copy(), self.test.copy(), n_jobs=1)
+        parallel = tf_idf(self.train.copy(), self.test.copy(), n_jobs=2, chunksize=100)
+        self.assert_same_matrices(serial, parallel)
+
+    def test_compact_auc(self):
+        ys = {tag: self.train[tag].values for tag in utils.TAGS}
+        full, _, _ = tf_idf(self.train.copy(), self.test.copy())
+        compact, _, _ = tf_idf(self.train.copy(), self.test.copy(), compact=True)
+        assert compact.dtype == np.float32 and compact.shape == full.shape
+
+        predictor = LogisticPredictor(C=4, dual=True)
+        full_auc = predictor.evaluate(full, ys, method='split')
+        compact_auc = predictor.evaluate(compact, ys, method='split')
+        assert compact_auc >= full_auc - 1e-3
+
+    def test_streaming_tf_idf(self):
+        """The streamed weights are the ones of HashingVectorizer + TfidfTransformer on the whole corpus"""
+        n_features = 2 ** 18
+        with tempfile.TemporaryDirectory() as tmp:
+            train_path, test_path = os.path.join(tmp, 'train.csv'), os.path.join(tmp, 'test.csv')
+            self.train[['comment_text']].to_csv(train_path, index=False)
+            self.test[['comment_text']].to_csv(test_path, index=False)
+            train, test = streaming_tf_idf(train_path, test_path, chunksize=300, n_features=n_features, min_df=1,
+                                           max_df=1.0, n_jobs=2)
+            # Read back, since empty comments are NaN once written to csv
+            comments = pd.concat([pd.read_csv(path)["comment_text"] for path in (train_path, test_path)])
+
+        comments = remove_numbers_helper(comments.fillna("unknown"))
+        vec = HashingVectorizer(ngram_range=(1, 2), tokenizer=Tokenizer(), strip_accents='unicode', n_features=n_features,
+                                alternate_sign=False, norm=None)
+        expected = TfidfTransformer(sublinear_tf=True, smooth_idf=True).fit_transform(vec.transform(comments.tolist()))
+
+        streamed = vstack([train, test])
+        assert streamed.shape == expected.shape
+        assert abs(streamed - expected).max() < 1e-10
+
+
+if __name__ == '__main__':
+    unittest.main()
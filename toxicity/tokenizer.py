@@ -0,0 +1,282 @@
+import multiprocessing
+import os
+import pickle
+from functools import lru_cache
+
+from sklearn.feature_extraction.text import strip_accents_unicode, strip_accents_ascii
+
+from utils import LRUCache, DedupIndex, fingerprint, nltk_data
+
+# Token emitted instead of words that make the stemmer/lemmatizer blow the recursion limit
+BIG_WORD = 'Big_word'
+
+# Maps the first letters of a Penn Treebank POS tag to the wordnet POS expected by the lemmatizer
+POS_MAP = [("NN", 'n'), ("VB", 'v'), ("JJ", 'a'), ("R", 'r')]
+
+# NLTK resources used by the tokenizer, as (resource path, package) pairs, see `utils.nltk_data`
+PUNKT = ('tokenizers/punkt', 'punkt')
+POS_TAGGER = ('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger')
+WORDNET = ('corpora/wordnet', 'wordnet')
+
+# Used by the worker processes of `tokenize_corpus`, set once per process by `_init_worker`
+_worker_state = {}
+
+
+@lru_cache(maxsize=None)
+def _require_nltk_data(resource, package):
+    """Makes sure an NLTK resource is available, checking it only once per process."""
+    nltk_data(resource, package)
+
+
+class Tokenizer(object):
+    """
+    A picklable version of the tokenizers used by `tf_idf`, so it can be shipped to worker processes.
+
+    The stemmer and lemmatizer are created lazily, only once per process, instead of once per comment.
+    Since the vocabulary is tiny compared to the number of token occurrences, stems and lemmas are memoized in an
+    LRU cache which can be persisted to `cache_path` and reloaded by the next run.
+    """
+
+    def __init__(self, stemming=True, lemmatization=False, cache_size=2 ** 20, cache_path=None):
+        """
+        :param stemming: If True tokens are stemmed using the Porter stemmer
+        :param lemmatization: If True tokens are lemmatized using their POS tag
+        :param cache_size: Maximum number of memoized stems/lemmas. Set to 0 or None to disable memoization
+        :param cache_path: File the memoized stems/lemmas are loaded from, if it exists, and saved to by `save_cache`
+        """
+        if stemming and lemmatization:
+            raise ValueError("It is not possible to apply both stemming and lemmatization. Please choose one of them.")
+        self.stemming = stemming
+        self.lemmatization = lemmatization
+        self.cache_path = cache_path
+        self.cache = None
+        if cache_size and (stemming or lemmatization):
+            if cache_path and os.path.exists(cache_path):
+                self.cache = LRUCache.load(cache_path, cache_size)
+            else:
+                self.cache = LRUCache(cache_size)
+        self._stemmer = None
+        self._lemmatizer = None
+        # Entries memoized since the last call of `pop_learned`, only tracked inside worker processes
+        self._learned = None
+
+    def __getstate__(self):
+        # NLTK models are rebuilt on the other side, no need to pickle them.
+        state = self.__dict__.copy()
+        state['_stemmer'] = None
+        state['_lemmatizer'] = None
+        return state
+
+    def __repr__(self):
+        return "Tokenizer(stemming={}, lemmatization={})".format(self.stemming, self.lemmatization)
+
+    def _memoize(self, key, compute):
+        if self.cache is None:
+            return compute()
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            self.cache.put(key, value)
+            if self._learned is not None:
+                self._learned[key] = value
+        return value
+
+    def _stem(self, token):
+        def compute():
+            if self._stemmer is None:
+                from nltk.stem import PorterStemmer
+                self._stemmer = PorterStemmer()
+            try:
+                return self._stemmer.stem(token)
+            except RecursionError:
+                return BIG_WORD
+        return self._memoize(token, compute)
+
+    def _lemmatize(self, token, tag):
+        pos = next((pos for prefix, pos in POS_MAP if tag.startswith(prefix)), None)
+
+        def compute():
+            if self._lemmatizer is None:
+                from nltk.stem import WordNetLemmatizer
+                _require_nltk_data(*WORDNET)
+                self._lemmatizer = WordNetLemmatizer()
+            try:
+                if pos is None:
+                    return self._lemmatizer.lemmatize(token)
+                return self._lemmatizer.lemmatize(token, pos=pos)
+            except RecursionError:
+                return BIG_WORD
+        return self._memoize((token, pos), compute)
+
+    def __call__(self, s):
+        # NLTK is slow to import, it is only loaded once something is tokenized
+        import nltk
+        _require_nltk_data(*PUNKT)
+        if self.stemming:
+            return [self._stem(token) for token in nltk.word_tokenize(s)]
+        if self.lemmatization:
+            _require_nltk_data(*POS_TAGGER)
+            return [self._lemmatize(token, tag) for token, tag in nltk.pos_tag(nltk.word_tokenize(s))]
+        try:
+            return nltk.word_tokenize(s)
+        except TypeError:
+            return ["UNKNOWN"]
+
+    def track_learned(self):
+        """Starts tracking new cache entries and resets the counters, used by worker processes."""
+        if self.cache is not None:
+            self._learned = {}
+            self.cache.hits = self.cache.misses = 0
+
+    def pop_learned(self):
+        """
+        :return: Tuple of (entries, hits, misses) accumulated since the last call, used by worker processes.
+        """
+        if self.cache is None:
+            return {}, 0, 0
+        learned = (self._learned, self.cache.hits, self.cache.misses)
+        self.track_learned()
+        return learned
+
+    def merge_learned(self, entries, hits, misses):
+        """Adds what a worker process learned to the cache of this tokenizer."""
+        if self.cache is not None:
+            self.cache.update(entries.items())
+            self.cache.hits += hits
+            self.cache.misses += misses
+
+    def save_cache(self):
+        """Persists the memoized stems/lemmas to `cache_path`, if any."""
+        if self.cache is not None and self.cache_path:
+            self.cache.save(self.cache_path)
+
+
+def _identity(x):
+    """Used as the tokenizer and preprocessor of vectorizers that are fed already tokenized documents."""
+    return x
+
+
+def _preprocess(doc, lowercase, strip_accents):
+    """Mimics the preprocessing a `TfidfVectorizer` applies to every document before tokenizing it."""
+    if not isinstance(doc, str):
+        return doc
+    if lowercase:
+        doc = doc.lower()
+    if strip_accents == 'unicode':
+        doc = strip_accents_unicode(doc)
+    elif strip_accents == 'ascii':
+        doc = strip_accents_ascii(doc)
+    elif callable(strip_accents):
+        doc = strip_accents(doc)
+    return doc
+
+
+def _tokenize_chunk(chunk, tokenizer, lowercase, strip_accents):
+    return [tokenizer(_preprocess(doc, lowercase, strip_accents)) for doc in chunk]
+
+
+def _init_worker(tokenizer, lowercase, strip_accents):
+    if isinstance(tokenizer, Tokenizer):
+        tokenizer.track_learned()
+    _worker_state['args'] = (tokenizer, lowercase, strip_accents)
+
+
+def _tokenize_chunk_worker(chunk):
+    tokenizer = _worker_state['args'][0]
+    tokens = _tokenize_chunk(chunk, *_worker_state['args'])
+    learned = tokenizer.pop_learned() if isinstance(tokenizer, Tokenizer) else None
+    return tokens, learned
+
+
+def tokenize_corpus(texts, tokenizer, lowercase=True, strip_accents=None, n_jobs=None, chunksize=10000):
+    """
+    Tokenizes a list of documents, in parallel if asked to.
+
+    The corpus is split in chunks of `chunksize` documents which are distributed to a pool of worker processes.
+    Each worker receives its own copy of the tokenizer once, thus one stemmer/lemmatizer per process.
+    The output is identical to tokenizing the documents one by one in the current process.
+    Stems/lemmas memoized by the workers are merged back into the cache of the given `Tokenizer`.
+
+    :param texts: List of documents (strings)
+    :param tokenizer: Callable mapping a document to a list of tokens. Must be picklable if `n_jobs` > 1
+    :param lowercase: Whether documents are lowercased before being tokenized, as done by `TfidfVectorizer`
+    :param strip_accents: One of 'unicode', 'ascii', None or a callable, as in `TfidfVectorizer`
+    :param n_jobs: Number of worker processes. Defaults to all cores but one
+    :param chunksize: Number of documents sent to a worker at once
+    :return: List of token lists, in the same order as `texts`
+    """
+    n_jobs = n_jobs or max(1, multiprocessing.cpu_count() - 1)
+    if n_jobs == 1 or len(texts) <= chunksize:
+        return _tokenize_chunk(texts, tokenizer, lowercase, strip_accents)
+
+    chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+    pool = multiprocessing.Pool(processes=min(n_jobs, len(chunks)), initializer=_init_worker,
+                                initargs=(tokenizer, lowercase, strip_accents))
+    try:
+        tokenized = pool.map(_tokenize_chunk_worker, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    for _, learned in tokenized:
+        if learned is not None:
+            tokenizer.merge_learned(*learned)
+    return [tokens for chunk, _ in tokenized for tokens in chunk]
+
+
+def token_store_dir(data_dir):
+    """The directory of the token store shared by all the preprocessing functions, see `load_or_tokenize`."""
+    return os.path.join(data_dir, 'output', 'tokens')
+
+
+def load_or_tokenize(texts, tokenizer, lowercase=True, strip_accents=None, n_jobs=None, chunksize=10000, store_dir=None):
+    """
+    Token store: Tokenizes the corpus only once for a given tokenizer setting and persists the token streams.
+    Duplicate documents are tokenized only once, see `utils.DedupIndex`, and share their list of tokens.
+
+    The token lists are stored in `store_dir` keyed by a fingerprint of the documents and the tokenizer settings,
+    so that every preprocessing function working on the same corpus with the same settings reuses them.
+    See `tokenize_corpus` for the parameters.
+
+    :param store_dir: Directory of the token store. If None, the tokens are computed but not persisted
+    :return: List of token lists, in the same order as `texts`
+    """
+    def tokenize():
+        index = DedupIndex(texts)
+        print("Tokenizing {}".format(index))
+        return index.scatter(tokenize_corpus(index.unique.tolist(), tokenizer, lowercase, strip_accents, n_jobs, chunksize))
+
+    if not store_dir:
+        return tokenize()
+
+    key = fingerprint(texts, tokenizer, lowercase, strip_accents)
+    if key is None:
+        return tokenize()
+    path = os.path.join(store_dir, 'tokens_{}.pkl'.format(key))
+    if os.path.exists(path):
+        print("Loading tokens from {}".format(path))
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    tokens = tokenize()
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    with open(path, 'wb') as f:
+        pickle.dump(tokens, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return tokens
+
+
+def pretokenized_params(params):
+    """
+    Adapts `TfidfVectorizer` parameters so that the vectorizer can be fed the output of `tokenize_corpus`.
+
+    :param params: Parameters of a word based `TfidfVectorizer` using a custom tokenizer
+    :return: Tuple of (tokenizer, lowercase, strip_accents, params) where the first three are used for
+             tokenizing with `load_or_tokenize` and the latter to create the vectorizer
+    """
+    params = dict(params)
+    tokenizer = params.pop('tokenizer')
+    lowercase = params.pop('lowercase', True)
+    strip_accents = params.pop('strip_accents', None)
+    params.update(tokenizer=_identity, preprocessor=_identity, lowercase=False, token_pattern=None)
+    return tokenizer, lowercase, strip_accents, params
@@ -5,37 +5,65 @@ from functools import partial
 
 import sys
 
-from GPyOpt.methods import BayesianOptimization
-
 sys.path.append('..')
-from utils import timing # noqa
+from utils import timing, load_sparse_csr # noqa
+from predictor import Predictor # noqa
 
 TUNING_OUTPUT_DEFAULT = 'data/tuning.txt'
 
 
-def eval_permutation(params, predictor_cls, train_x, train_ys, method='split', nfolds=3, silent=True):
+def eval_permutation(params, predictor_cls, train_x, train_ys, method='split', nfolds=3, silent=True, fold_cache=None):
     """
     Evaluates a predictor using a certain param set on the given training set.
     Note: This could be nested but multiprocessing can not picke it so it shall remain global.
 
     :param params: Parameters to be evaluated
     :param predictor_cls: The predictors class name - NOT an object of the class
-    :param train_x: Contains the preprocessed input features
+    :param train_x: Contains the preprocessed input features, or the path of a sparse matrix saved with `save_sparse_csr`
+                    which is then memory-mapped instead of being copied into every worker process
     :param train_ys: Dictionary mapping tag names to their array of values
     :param method: Method to be used for evaluation. Set to split for speed by default, CV might be more robust
     :param nfolds: Number of folds to be used by cross-validation (only used if method='CV')
     :param silent: Whether or not progress messages will be printed
+    :param fold_cache: The `FoldCache` holding the folds, see `Predictor.evaluate`
     :return: Tuple of (params, score)
     """
     if not silent:
         print("Evaluating {}".format(params))
         sys.stdout.flush()  # Force child processes to print
 
+    if isinstance(train_x, str):
+        train_x = load_sparse_csr(train_x, mmap_mode='r')
+
     predictor = predictor_cls(**params)
-    score = predictor.evaluate(train_x, train_ys, method=method, nfolds=nfolds)
+    score = predictor.evaluate(train_x, train_ys, method=method, nfolds=nfolds, fold_cache=fold_cache)
     return tuple(sorted(params.items())), score
 
 
+def eval_path(params, predictor_cls, train_x, train_ys, path_param, method='split', nfolds=3, silent=True, fold_cache=None):
+    """
+    Evaluates a predictor for every value of `path_param` at once, see `Predictor.evaluate_path`.
+
+    :param params: Parameters to be evaluated, the one named `path_param` mapping to the list of its values
+    :param path_param: Name of the parameter whose values are evaluated together
+    :return: List of tuples (params, score), one per value of `path_param`
+
+    See `eval_permutation` for the other parameters.
+    """
+    if not silent:
+        print("Evaluating {}".format(params))
+        sys.stdout.flush()  # Force child processes to print
+
+    if isinstance(train_x, str):
+        train_x = load_sparse_csr(train_x, mmap_mode='r')
+
+    fixed = {name: value for name, value in params.items() if name != path_param}
+    predictor = predictor_cls(**dict(fixed, **{path_param: params[path_param][0]}))
+    path = predictor.evaluate_path(train_x, train_ys, path_param, params[path_param], method=method, nfolds=nfolds,
+                                   fold_cache=fold_cache)
+    return [(tuple(sorted(dict(fixed, **{path_param: value}).items())), score) for value, score in path]
+
+
 def write_results(write_to, scores, predictor_cls):
     """ Writes experiment results to specified file """
     with open(write_to, "a") as f:
@@ -52,7 +80,7 @@ def bayesian_optimization(predictor_cls, train_x, train_ys, params, max_iter, ma
     Automatically configures hyperparameters of ML algorithms. Suitable for reasonably small sets of params.
 
     :param predictor_cls: The predictors class
-    :param train_x Contains the preprocessed input features
+    :param train_x Contains the preprocessed input features, or the path of a sparse matrix saved with `save_sparse_csr`
     :param train_ys Dictionary mapping tag names to their array of values
     :param params: Dictionary of parameters, type (continuous/discrete), and their allowed ranges/values.
            NOTE: param_ranges must first contain continuous variables, then discrete.
@@ -128,7 +156,8 @@ def bayesian_optimization(predictor_cls, train_x, train_ys, params, max_iter, ma
     if not silent:
         print("Running Bayesian Optimization in batches of {} on {} cores using {}.".format(batch_size, num_cores, batch_method))
 
-    # define optimization problem
+    # define optimization problem, GPyOpt is imported here since it is slow to import and only needed by this function
+    from GPyOpt.methods import BayesianOptimization
     opt = BayesianOptimization(f, domain=params, model_type=model_type, acquisition_type=acquisition_type,
                                normalize_Y=False, acquisition_weight=acquisition_weight, num_cores=num_cores, batch_size=batch_size)
 
@@ -146,12 +175,14 @@ def bayesian_optimization(predictor_cls, train_x, train_ys, params, max_iter, ma
 
 @timing
 def tune(predictor_cls, train_x, train_ys, param_grid, method='split', nfolds=3, silent=True, persist=True,
-         write_to=TUNING_OUTPUT_DEFAULT):
+         write_to=TUNING_OUTPUT_DEFAULT, path_param=None, fold_cache=None):
     """
     Exhaustively searches over the grid of parameters for the best combination by minimizing the log loss.
 
     :param predictor_cls: The predictors class name - NOT an object of the class
-    :param train_x Contains the preprocessed input features
+    :param train_x Contains the preprocessed input features, or the path of a sparse matrix saved with `save_sparse_csr`.
+                   Passing a path is recommended for large matrices: every child process memory-maps the same files
+                   instead of receiving its own pickled copy of the matrix.
     :param train_ys Dictionary mapping tag names to their array of values
     :param param_grid: Grid of parameters to be explored.
     :param method: Method to be used for evaluation. Set to split for speed by default, CV might be more robust
@@ -159,6 +190,12 @@ def tune(predictor_cls, train_x, train_ys, param_grid, method='split', nfolds=3,
     :param silent: Whether or not progress messages will be printed
     :param persist: If set to true, will write tuning results to a file
     :param write_to: If persist is set to True, write_to defines the filepath to write to
+    :param path_param: Name of a parameter whose values are evaluated together by every child process, e.g. 'C' for
+                       `LogisticPredictor` which fits its regularization path with warm starts. Not supported by the
+                       'stratified_CV' method.
+    :param fold_cache: The `FoldCache` shared by all the permutations, see `Predictor.evaluate`. The folds are computed
+                       once before the child processes start; give the cache a directory so that they memory-map the
+                       persisted folds instead of receiving a pickled copy.
     :return: tuple of: (Best parameters found, Best score achieved).
     """
 
@@ -197,19 +234,44 @@ def tune(predictor_cls, train_x, train_ys, param_grid, method='split', nfolds=3,
     permutations = get_permutations(param_grid)
     print("Applying GridSearch for {} permutations of parameters".format(len(permutations)))
 
+    if path_param:
+        # Group the permutations differing only by the value of `path_param`
+        paths = {}
+        for params in permutations:
+            fixed = tuple(sorted((name, value) for name, value in params.items() if name != path_param))
+            paths.setdefault(fixed, []).append(params[path_param])
+        permutations = [dict(fixed, **{path_param: values}) for fixed, values in paths.items()]
+
     processes = min(max(1, multiprocessing.cpu_count() - 1), len(permutations))
     if not silent:
         print("Running tune in parallel using {} child processes".format(processes))
 
+    if fold_cache:
+        x = load_sparse_csr(train_x, mmap_mode='r') if isinstance(train_x, str) else train_x
+        Predictor.folds(x, train_ys, method, nfolds, fold_cache=fold_cache)
+
     pool = multiprocessing.Pool(processes=processes)
-    evaluator = partial(eval_permutation,
-                        predictor_cls=predictor_cls,
-                        train_x=train_x,
-                        train_ys=train_ys,
-                        method=method,
-                        nfolds=nfolds,
-                        silent=silent)
-    scores = pool.map(evaluator, permutations)
+    if path_param:
+        evaluator = partial(eval_path,
+                            predictor_cls=predictor_cls,
+                            train_x=train_x,
+                            train_ys=train_ys,
+                            path_param=path_param,
+                            method=method,
+                            nfolds=nfolds,
+                            silent=silent,
+                            fold_cache=fold_cache)
+        scores = [score for path in pool.map(evaluator, permutations) for score in path]
+    else:
+        evaluator = partial(eval_permutation,
+                            predictor_cls=predictor_cls,
+                            train_x=train_x,
+                            train_ys=train_ys,
+                            method=method,
+                            nfolds=nfolds,
+                            silent=silent,
+                            fold_cache=fold_cache)
+        scores = pool.map(evaluator, permutations)
 
     if persist:
         write_results(write_to, scores, predictor_cls)
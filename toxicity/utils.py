@@ -1,11 +1,23 @@
+import os
+import json
 import time
+import pickle
+import hashlib
+import inspect
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse, hstack
 from sklearn import preprocessing
 
 TAGS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
 
+# The arrays a CSR matrix consists of, each of them is saved in its own file by `save_sparse_csr`
+CSR_ARRAYS = ['data', 'indices', 'indptr']
+
+# Describes the columns of a frame saved by `save_dense_frame`
+FRAME_META = 'columns.json'
+
 
 def timing(f):
     """
@@ -24,6 +36,185 @@ def timing(f):
     return wrap
 
 
+class _Described(object):
+    """Stands for a parameter in a `repr`, with a description which is stable across runs, see `describe`."""
+
+    def __init__(self, description):
+        self.description = description
+
+    def __repr__(self):
+        return self.description
+
+
+# Ids of the functions being described, see `describe`
+_describing = set()
+
+
+def _code_digest(code):
+    """Digest of the bytecode and constants of a code object, including the ones of the functions nested in it."""
+    md5 = hashlib.md5(code.co_code)
+    md5.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        description = _code_digest(const) if inspect.iscode(const) else describe(const)
+        if description is None:
+            return None
+        md5.update(description.encode('utf-8'))
+    return md5.hexdigest()
+
+
+def describe(obj):
+    """
+    A description of the parameter which is stable across runs, unlike the default `repr` of functions.
+
+    Functions are described by their module, qualified name and a digest of their code, default arguments and
+    closure, so that two lambdas, two closures of the same factory or an edited function are told apart. Classes
+    and builtins are described by their module and qualified name, bound methods by their function and instance.
+
+    :return: The description, or None if the parameter can not be identified, e.g. an object with the default `repr`
+    """
+    if inspect.isfunction(obj):
+        name = "{}.{}".format(obj.__module__, obj.__qualname__)
+        if id(obj) in _describing:
+            # A recursive function found in its own closure
+            return name
+        _describing.add(id(obj))
+        try:
+            parts = [_code_digest(obj.__code__), describe(obj.__defaults__), describe(obj.__kwdefaults__)]
+            parts += [describe(cell.cell_contents) for cell in obj.__closure__ or ()]
+        finally:
+            _describing.discard(id(obj))
+        if None in parts:
+            return None
+        return "{}:{}".format(name, hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest())
+    if inspect.ismethod(obj) or (inspect.isbuiltin(obj) and obj.__self__ is not None and not inspect.ismodule(obj.__self__)):
+        # Bound methods, e.g. the `findall` of a compiled regex
+        function = describe(obj.__func__) if inspect.ismethod(obj) else obj.__qualname__
+        instance = describe(obj.__self__)
+        return None if function is None or instance is None else "{} of {}".format(function, instance)
+    if hasattr(obj, '__qualname__'):
+        # Method descriptors, e.g. `str.split`, only know their class
+        module = getattr(obj, '__module__', None) or getattr(getattr(obj, '__objclass__', None), '__module__', None)
+        return "{}.{}".format(module, obj.__qualname__)
+    if isinstance(obj, (list, tuple, dict, set, frozenset)):
+        try:
+            return repr(_stable(obj))
+        except _Undescribable:
+            return None
+
+    description = repr(obj)
+    # The default `repr` of objects holds their address, which changes across runs
+    return None if ' at 0x' in description else description
+
+
+class _Undescribable(Exception):
+    pass
+
+
+def _stable(obj):
+    """
+    Replaces the values nested in the parameter by their description, see `describe`.
+    Raises `_Undescribable` if one of them can not be described.
+    """
+    if isinstance(obj, dict):
+        return {key: _stable(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_stable(value) for value in obj)
+    if isinstance(obj, (set, frozenset)):
+        # The iteration order of sets of strings changes across runs
+        return _Described('{' + ', '.join(sorted(repr(_stable(value)) for value in obj)) + '}')
+    description = describe(obj)
+    if description is None:
+        raise _Undescribable(repr(obj))
+    return _Described(description)
+
+
+def fingerprint(*objects):
+    """
+    Computes a hash identifying the content of the given objects, used to key artifacts persisted on disk.
+
+    :param objects: Any number of pd.DataFrames, pd.Series, np.ndarrays, sparse matrices, lists of documents or
+                    plain python values (parameters) whose `repr` identifies them. Functions and classes, e.g. a
+                    custom tokenizer, are identified by `describe`.
+    :return: Hex digest of the hash, or None if a parameter can not be identified, in which case nothing should be
+             cached for it
+    """
+    md5 = hashlib.md5()
+    for obj in objects:
+        if isinstance(obj, list):
+            obj = pd.Series(obj, dtype=object)
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            md5.update(repr(obj.columns.tolist() if isinstance(obj, pd.DataFrame) else obj.name).encode('utf-8'))
+            md5.update(pd.util.hash_pandas_object(obj, index=False).values.tobytes())
+        elif issparse(obj):
+            obj = obj.tocsr()
+            md5.update(repr(obj.shape).encode('utf-8'))
+            for array in (obj.data, obj.indices, obj.indptr):
+                md5.update(np.ascontiguousarray(array).tobytes())
+        elif isinstance(obj, np.ndarray):
+            md5.update(repr((obj.shape, obj.dtype.str)).encode('utf-8'))
+            md5.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            try:
+                params = sorted(_stable(obj).items()) if isinstance(obj, dict) else _stable(obj)
+            except _Undescribable as e:
+                print("Can not identify the parameter {}, it is not cached".format(e))
+                return None
+            md5.update(repr(params).encode('utf-8'))
+        # Separator so that consecutive objects can not be confused with each other
+        md5.update(b'|')
+    return md5.hexdigest()
+
+
+def compact_frame(frame, columns=None):
+    """
+    Downcasts the numeric columns of a DataFrame: integers to the smallest integer type holding all their values and
+    floats to float32. Other columns are left as they are.
+
+    :param frame: pd.DataFrame, modified in place
+    :param columns: Names of the columns to downcast, all of them if None
+    :return: The same pd.DataFrame
+    """
+    for name in frame.columns if columns is None else columns:
+        kind = frame[name].dtype.kind
+        if kind in 'iu':
+            frame[name] = pd.to_numeric(frame[name], downcast='integer' if kind == 'i' else 'unsigned')
+        elif kind == 'f':
+            frame[name] = frame[name].astype(np.float32)
+    return frame
+
+
+def nltk_data(resource, package):
+    """
+    Makes sure an NLTK resource is available, looking for it in the local nltk_data directories first so that nothing
+    is downloaded, and the network is not needed, once it is installed.
+
+    :param resource: Path of the resource in nltk_data, e.g. 'corpora/stopwords'
+    :param package: Name of the NLTK package holding the resource, e.g. 'stopwords'
+    """
+    import nltk
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        print("NLTK resource {} not found locally, downloading {}".format(resource, package))
+        nltk.download(package)
+
+
+def label_matrix(ys):
+    """
+    :param ys: Dictionary or pd.DataFrame mapping every tag of `TAGS` to its labels, or an array of shape
+               (n_samples, len(TAGS))
+    :return: Array of shape (n_samples, len(TAGS))
+    """
+    if isinstance(ys, (dict, pd.DataFrame)):
+        return np.column_stack([ys[tag] for tag in TAGS])
+    return np.asarray(ys)
+
+
+def select_rows(x, index):
+    """Selects rows of a (sparse) matrix or of a pd.DataFrame."""
+    return x.iloc[index] if hasattr(x, 'iloc') else x[index]
+
+
 def scale_data(train, test):
     """
     Creates an scaled version of the train and test sets. This step is necesary to
@@ -41,7 +232,32 @@ def scale_data(train, test):
     return scaler.transform(train), scaler.transform(test)
 
 
-def create_submission(predictor, train_x, train_ys, test_x, test_id, write_to):
+def feature_union(train_sparse, test_sparse, train_dense, test_dense, columns=None):
+    """
+    Appends dense engineered features (e.g. the output of `FeatureAdder.get_features`) to sparse text features (e.g. the
+    output of `get_sparse_matrix`), without ever densifying the latter.
+
+    The dense columns are scaled by their maximum absolute value in the train set. Unlike the `StandardScaler` used by
+    `scale_data`, this does not center them, so the result stays sparse and its values have the same range as TF-IDF.
+
+    :param train_sparse, test_sparse: Sparse matrices of the train and test sets
+    :param train_dense, test_dense: pd.DataFrames of features of the train and test sets, aligned with the matrices
+    :param columns: Names of the columns to append. Defaults to all the numeric columns which are not tags
+    :return: (train, test) CSR matrices with the dtype of the sparse matrices, the dense columns coming last
+    """
+    if columns is None:
+        columns = [name for name in train_dense.columns if name not in TAGS and train_dense[name].dtype.kind in 'biuf']
+    dtype = train_sparse.dtype
+
+    scaler = preprocessing.MaxAbsScaler().fit(train_dense[columns].values.astype(np.float64))
+    union = []
+    for sparse, dense in ((train_sparse, train_dense), (test_sparse, test_dense)):
+        scaled = scaler.transform(dense[columns].values.astype(np.float64)).astype(dtype)
+        union.append(hstack([sparse, csr_matrix(scaled)], format='csr', dtype=dtype))
+    return union[0], union[1]
+
+
+def create_submission(predictor, train_x, train_ys, test_x, test_id, write_to, n_jobs=None):
     """
     Creates a submissions file for the given test set
 
@@ -50,13 +266,15 @@ def create_submission(predictor, train_x, train_ys, test_x, test_id, write_to):
     :param train_ys: A dictionary from tag name to its values in the training set.
     :param test_x: The (preprocessed) features to be used for predicting.
     :param write_to: A file path where the submission is written
+    :param n_jobs: Number of processes fitting the tags, see `Predictor.fit_all`
     """
     submission = pd.DataFrame({'id': test_id})
 
-    for tag in TAGS:
-        print("{} Fitting on {} tag".format(predictor, tag))
-        predictor.fit(train_x, train_ys[tag])
-        submission[tag] = predictor.predict_proba(test_x)
+    print("{} Fitting on all tags".format(predictor))
+    predictor.fit_all(train_x, train_ys, n_jobs=n_jobs)
+    probabilities = predictor.predict_proba_all(test_x)
+    for i, tag in enumerate(TAGS):
+        submission[tag] = probabilities[:, i]
 
     submission.to_csv(write_to, index=False)
     print("Submissions created at location " + write_to)
@@ -66,29 +284,253 @@ def save_sparse_csr(filename, matrix):
         """
         Save sparce matrices
 
+        The matrix is saved as a directory holding one .npy file per CSR array (data, indices, indptr) plus its shape,
+        so that `load_sparse_csr` can memory-map them instead of reading them in memory.
+
         Parameters
         -------------------------
-        filename: name of the file where the sparce matrix is saved
+        filename: name of the directory where the sparce matrix is saved
         matrix: saprce matrix to be saved
 
         Returns
         --------------------------
-        .npz document
+        directory of .npy documents
         """
-        np.savez(filename, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape)
+        matrix = matrix.tocsr()
+        if not matrix.has_canonical_format:
+            # Memory-mapped arrays are read only, so they must not need sorting or deduplication later on
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+        for name in CSR_ARRAYS:
+            np.save(os.path.join(filename, name + '.npy'), getattr(matrix, name))
+        np.save(os.path.join(filename, 'shape.npy'), np.array(matrix.shape))
 
 
-def load_sparse_csr(filename):
+def load_sparse_csr(filename, mmap_mode=None):
         """
         Load sparce matrices
 
         Parameters
         -------------------------
-        filename: name of the file where the sparce matrix is saved
+        filename: name of the directory (or of the legacy .npz file) where the sparce matrix is saved
+        mmap_mode: None to read the matrix in memory, 'r' to memory-map it read-only. A memory-mapped matrix is loaded
+                   almost instantly and shares the page cache with every other process mapping the same files.
+                   Ignored for legacy .npz files.
 
         Returns
         --------------------------
         sparce matrix
         """
-        loader = np.load(filename)
-        return csr_matrix((loader['data'], loader['indices'], loader['indptr']), shape=loader['shape'])
+        if not os.path.isdir(filename):
+            loader = np.load(filename)
+            return csr_matrix((loader['data'], loader['indices'], loader['indptr']), shape=loader['shape'])
+
+        arrays = [np.load(os.path.join(filename, name + '.npy'), mmap_mode=mmap_mode) for name in CSR_ARRAYS]
+        shape = tuple(np.load(os.path.join(filename, 'shape.npy')))
+        matrix = csr_matrix(tuple(arrays), shape=shape, copy=False)
+        matrix.has_canonical_format = True
+        return matrix
+
+
+def save_dense_frame(dirname, frame, compress=False):
+    """
+    Saves a DataFrame of features in a binary columnar format, much faster to write and read than a csv and lossless.
+
+    Every column is stored as its own typed array, so `load_dense_frame` can read only the columns it needs.
+    Text columns (e.g. `id`) are stored as fixed width unicode arrays. Other object columns, e.g. text with missing
+    values or mixed types, are pickled, so they are read back as they were but can not be memory-mapped.
+    The index is not saved.
+
+    :param dirname: Directory where the frame is saved
+    :param frame: pd.DataFrame to be saved
+    :param compress: If True, all columns are saved in one compressed .npz file. Smaller on disk, but the
+                     columns can not be memory-mapped anymore
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    columns, arrays = [], {}
+    for i, (name, column) in enumerate(frame.items()):
+        values = np.asarray(column)
+        dtype = values.dtype.str
+        pickled = values.dtype == object and not all(isinstance(value, str) for value in values)
+        if values.dtype == object and not pickled:
+            values = values.astype(str)
+        arrays['column_{}'.format(i)] = values
+        columns.append({'name': name.item() if isinstance(name, np.generic) else name, 'dtype': dtype, 'pickled': pickled})
+
+    if compress:
+        np.savez_compressed(os.path.join(dirname, 'columns.npz'), **arrays)
+    else:
+        for array_name, values in arrays.items():
+            np.save(os.path.join(dirname, array_name + '.npy'), values)
+    with open(os.path.join(dirname, FRAME_META), 'w') as f:
+        json.dump({'columns': columns, 'compressed': compress}, f)
+
+
+def load_dense_frame(dirname, columns=None, mmap_mode=None):
+    """
+    Loads a DataFrame saved by `save_dense_frame`.
+
+    :param dirname: Directory where the frame is saved
+    :param columns: List of the names of the columns to be loaded, all of them if None
+    :param mmap_mode: None to read the columns in memory, 'r' to memory-map them. Ignored for compressed frames and
+                      pickled columns
+    :return: pd.DataFrame with the requested columns, in the order they were saved, and a default index
+    """
+    with open(os.path.join(dirname, FRAME_META)) as f:
+        meta = json.load(f)
+
+    saved = [(i, column) for i, column in enumerate(meta['columns']) if columns is None or column['name'] in columns]
+    if columns is not None and len(saved) < len(set(columns)):
+        missing = set(columns) - set(column['name'] for _, column in saved)
+        raise KeyError("Columns {} are not saved in {}".format(sorted(missing, key=str), dirname))
+
+    if meta['compressed']:
+        archive = np.load(os.path.join(dirname, 'columns.npz'), allow_pickle=True)
+
+        def read(array_name, pickled):
+            return archive[array_name]
+    else:
+        def read(array_name, pickled):
+            return np.load(os.path.join(dirname, array_name + '.npy'), mmap_mode=None if pickled else mmap_mode,
+                           allow_pickle=pickled)
+
+    data = OrderedDict()
+    for i, column in saved:
+        values = read('column_{}'.format(i), column.get('pickled', False))
+        dtype = np.dtype(column['dtype'])
+        data[column['name']] = values.astype(object) if dtype == object else values
+    return pd.DataFrame(data, columns=[column['name'] for _, column in saved])
+
+
+class DedupIndex(object):
+    """
+    Index of the distinct texts of a corpus, so that expensive transformations are computed once per distinct text
+    and scattered back to all the rows holding it. A good share of the comments are exact duplicates.
+
+    Texts are hashed as they are, so they should be normalized (e.g. by removing numbers) beforehand, the output is
+    then exactly the one of transforming every row.
+
+    Example
+    -------
+        >>> index = DedupIndex(comments)
+        >>> tokens = index.scatter([tokenize(text) for text in index.unique])
+    """
+
+    def __init__(self, texts):
+        """
+        :param texts: List or pd.Series of texts, missing values (NaN) are a distinct text of their own
+        """
+        codes, uniques = pd.factorize(pd.Series(texts, dtype=object))
+        uniques = np.asarray(uniques, dtype=object)
+        missing = codes == -1
+        if missing.any():
+            codes[missing] = len(uniques)
+            uniques = np.append(uniques, np.nan)
+        # Position in `unique` of the text of every row
+        self.codes = codes
+        # The distinct texts, in order of first appearance
+        self.unique = uniques
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __str__(self):
+        return "{} distinct texts out of {} ({:.1%} duplicates)".format(len(self.unique), len(self), 1 - self.ratio)
+
+    @property
+    def ratio(self):
+        """Number of distinct texts per row."""
+        return len(self.unique) / max(1, len(self))
+
+    def scatter(self, values):
+        """
+        :param values: The results computed for every text of `unique`, as a list, np.ndarray, sparse matrix or
+                       pd.DataFrame (one row per text)
+        :return: The results of every row, of the same type as `values`
+        """
+        if isinstance(values, list):
+            return [values[code] for code in self.codes]
+        if isinstance(values, (pd.DataFrame, pd.Series)):
+            return values.iloc[self.codes].reset_index(drop=True)
+        return values[self.codes]
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used entries once full.
+    It keeps track of hits and misses and can be persisted to disk, so that expensive computations survive across runs.
+    """
+
+    def __init__(self, maxsize=2 ** 20):
+        """
+        :param maxsize: Maximum number of entries kept in memory
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __str__(self):
+        return "{} entries, {} hits, {} misses".format(len(self), self.hits, self.misses)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the key or `default` if it is not in the cache, counting hits and misses.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Caches the value for the key, evicting the least recently used entries if the cache is full.
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def items(self):
+        return self._data.items()
+
+    def save(self, filename):
+        """
+        Persists the cached entries, from least to most recently used.
+
+        :param filename: Path of the pickle file to write to
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump(list(self._data.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename, maxsize=2 ** 20):
+        """
+        Creates a cache holding the entries persisted by `save`.
+
+        :param filename: Path of the pickle file to read from
+        :param maxsize: Maximum number of entries of the new cache
+        """
+        cache = cls(maxsize)
+        with open(filename, 'rb') as f:
+            cache.update(pickle.load(f))
+        return cache